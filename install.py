@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from pychallenge.models import Config, Match1on1, Player, Rank_Elo, Rank_Glicko
+from pychallenge.models import Config, Match1on1, Player, Rank_Elo, \
+    Rank_Glicko, Rank_Glicko2
 
 if __name__ == "__main__":
     Config.create()
@@ -9,3 +10,4 @@ if __name__ == "__main__":
     Player.create()
     Rank_Elo.create()
     Rank_Glicko.create()
+    Rank_Glicko2.create()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+The algorithms use NumPy and Numba if they are installed. These modules are
+only imported when an algorithm needs them, so that commands that do not
+rate matches start quickly.
+"""
+import importlib
+
+#: name --> the imported optional module, or None if it is not installed
+_modules = {}
+
+
+def optional(name):
+    """
+    Imports the optional module `name` on first use.
+
+    :param name: the name of the module, e.g. ``'numpy'``
+    :type name: String
+    :return: the module, or None if it is not installed
+    """
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
@@ -1,4 +1,25 @@
 # -*- coding: utf-8 -*-
+"""
+computes Elo ratings
+
+Whole match histories are replayed with :py:func:`replay`. It uses a kernel
+compiled with Numba if Numba is installed, or rates independent matches
+together with NumPy if NumPy is installed.
+"""
+import math
+import re
+from array import array
+from pychallenge.algorithms import optional, scheduler
+
+#: the minimum average number of matches per wave for which
+#: :py:func:`replay` uses :py:func:`_replayWaves`
+MIN_WAVE_SIZE = 32
+
+#: matches the source of the logistic Elo functions of the config, e.g.
+#: ``(lambda x:(1/(1+(10**(x/400.0)))))``; the group is the scale
+LOGISTIC_FUNCTION = re.compile(r"^\(?\s*lambda\s+x\s*:\s*\(?\s*1\s*/\s*"
+    r"\(\s*1\s*\+\s*\(?\s*10\s*\*\*\s*\(\s*x\s*/\s*(\d+\.\d*)\s*\)\s*\)?"
+    r"\s*\)\s*\)?\s*\)?$")
 
 
 def elo1on1(elo1, elo2, outcome, k, function):
@@ -34,3 +55,208 @@ def elo1on1(elo1, elo2, outcome, k, function):
     result = newelo1, newelo2
 
     return result
+
+
+def logisticScale(source):
+    """
+    Checks if `source` is a logistic Elo function like the chess function
+    ``lambda x:(1/(1+(10**(x/400.0))))``. These functions can be evaluated
+    by the compiled kernel of :py:func:`replay`.
+
+    :param source: the source of an Elo function, e.g. from the config
+    :type source: String
+    :return: the scale of the function (e.g. 400.0) or None
+    :rtype: float
+    """
+    match = LOGISTIC_FUNCTION.match(source.strip())
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def replay(ratings, player1List, player2List, outcomeList, k, function=None,
+        scale=None):
+    """
+    Replays a list of matches in their order, like calling
+    :py:func:`elo1on1` for each match, and stores the new ratings in
+    `ratings`. The players are given by their position in `ratings`.
+
+    If `scale` is given, the Elo function is the logistic function
+    ``1 / (1 + (10 ** (x / scale)))``. It is computed inline. If `ratings`
+    is an :py:class:`array.array` of doubles, the matches are replayed by a
+    kernel compiled with Numba if Numba is installed, or in waves of
+    independent matches with NumPy (see :py:func:`_replayWaves`). The
+    results are the same as those of :py:func:`elo1on1` with the function
+    and the integer ratings stored in the database, including the rounding
+    of Python 2 (half away from zero). Otherwise, `function` is called for
+    each match.
+
+    :param ratings: the ratings of the players, changed in place
+    :param player1List: the position of player 1 of each match
+    :param player2List: the position of player 2 of each match
+    :param outcomeList: the outcome of each match
+    :param k: k factor
+    :param function: Elo function e.g. chess lambda x:(1/(1+(10**(x/400.0))))
+    :param scale: the scale of a logistic Elo function, see
+        :py:func:`logisticScale`
+    :type ratings: :py:class:`array.array` or list
+    :type player1List: :py:class:`array.array` or list of integers
+    :type player2List: :py:class:`array.array` or list of integers
+    :type outcomeList: :py:class:`array.array` or list of floats
+    :type k: float
+    :type function: function
+    :type scale: float
+    """
+    assert len(player1List) == len(player2List) and \
+        len(player1List) == len(outcomeList)
+    assert function is not None or scale is not None
+    numpy = optional('numpy')
+    packed = scale is not None and numpy is not None and \
+        getattr(ratings, 'typecode', None) == 'd'
+    kernel = _replayKernel() if packed else None
+    if kernel is not None:
+        kernel(numpy.frombuffer(ratings, dtype=numpy.float64),
+            numpy.asarray(player1List, dtype=numpy.intp),
+            numpy.asarray(player2List, dtype=numpy.intp),
+            numpy.asarray(outcomeList, dtype=numpy.float64),
+            float(k), float(scale))
+        return
+    if packed and _replayWaves(numpy.frombuffer(ratings,
+            dtype=numpy.float64), player1List, player2List, outcomeList, k,
+            scale):
+        return
+
+    if scale is not None:
+        for player1, player2, outcome in zip(player1List, player2List,
+                outcomeList):
+            elo1 = ratings[player1]
+            elo2 = ratings[player2]
+            newelo1 = round(elo1 + k * (outcome -
+                (1 / (1 + (10 ** ((elo2 - elo1) / scale))))))
+            ratings[player1] = newelo1
+            ratings[player2] = elo2 - (newelo1 - elo1)
+    else:
+        for player1, player2, outcome in zip(player1List, player2List,
+                outcomeList):
+            elo1 = ratings[player1]
+            elo2 = ratings[player2]
+            newelo1 = round(elo1 + k * (outcome - function(elo2 - elo1)))
+            ratings[player1] = newelo1
+            ratings[player2] = elo2 - (newelo1 - elo1)
+
+
+def rateHistory(ratingList, player1List, player2List, outcomeList, k, scale):
+    """
+    Replays the matches with a logistic Elo function (see :py:func:`replay`)
+    and returns the new ratings. Unlike :py:func:`replay`, the arguments and
+    the result can be sent to another process, e.g. to rate independent
+    shards of the players (see
+    :py:func:`pychallenge.algorithms.scheduler.shards`) in parallel.
+
+    :param ratingList: the ratings of the players
+    :type ratingList: list of floats
+    :return: the new ratings of the players
+    :rtype: list of floats
+    """
+    ratings = array('d', ratingList)
+    replay(ratings, player1List, player2List, outcomeList, k, scale=scale)
+    return ratings.tolist()
+
+
+def _replay(ratings, player1List, player2List, outcomeList, k, scale):
+    """
+    The kernel of :py:func:`replay` for logistic Elo functions. It is
+    compiled with Numba, so it only uses NumPy arrays and floats. round()
+    is replaced by rounding half away from zero, like round() of Python 2.
+    """
+    for i in range(player1List.shape[0]):
+        player1 = player1List[i]
+        player2 = player2List[i]
+        elo1 = ratings[player1]
+        elo2 = ratings[player2]
+        newelo1 = elo1 + k * (outcomeList[i] -
+            (1.0 / (1.0 + (10.0 ** ((elo2 - elo1) / scale)))))
+        rounded = math.floor(newelo1)
+        rest = newelo1 - rounded
+        if rest > 0.5 or (rest == 0.5 and newelo1 >= 0.0):
+            rounded += 1.0
+        ratings[player1] = rounded
+        ratings[player2] = elo2 - (rounded - elo1)
+
+
+def _replayWaves(ratings, player1List, player2List, outcomeList, k, scale):
+    """
+    Replays the matches in waves of matches without a common player (see
+    :py:mod:`pychallenge.algorithms.scheduler`). The matches of a wave are
+    rated at once with NumPy: the ratings are gathered, the new ratings are
+    computed and scattered back.
+
+    The power function of NumPy may round differently than the one of
+    Python. Thus, the expectations are taken from a table that is computed
+    with the Elo function of Python for each rating difference. This
+    requires whole-numbered ratings, which is always the case after the
+    first match because the ratings are rounded.
+
+    :param ratings: the ratings of the players, changed in place
+    :type ratings: :py:class:`numpy.ndarray`
+    :return: False if nothing was done, because the ratings are not whole
+        numbers or the waves are too small to be worth it (see
+        :py:data:`MIN_WAVE_SIZE`)
+    :rtype: Boolean
+    """
+    numpy = optional('numpy')
+    if not len(player1List) or \
+            not (ratings == numpy.floor(ratings)).all():
+        return False
+    levels = numpy.asarray(scheduler.waveLevels(player1List, player2List,
+        len(ratings)), dtype=numpy.intp)
+    bounds = numpy.cumsum(numpy.bincount(levels)).tolist()
+    if len(player1List) < MIN_WAVE_SIZE * len(bounds):
+        return False
+
+    order = numpy.argsort(levels, kind='mergesort')
+    player1 = numpy.asarray(player1List, dtype=numpy.intp)[order]
+    player2 = numpy.asarray(player2List, dtype=numpy.intp)[order]
+    outcome = numpy.asarray(outcomeList, dtype=numpy.float64)[order]
+
+    # expected[limit + x] is the result of the Elo function for the rating
+    # difference x
+    limit = -1
+    expected = None
+    start = 0
+    for end in bounds:
+        player1Wave = player1[start:end]
+        player2Wave = player2[start:end]
+        elo1 = ratings[player1Wave]
+        elo2 = ratings[player2Wave]
+        diff = (elo2 - elo1).astype(numpy.intp)
+        if numpy.abs(diff).max() > limit:
+            limit = max(2 * int(numpy.abs(diff).max()), 1024)
+            expected = numpy.array([1 / (1 + (10 ** (x / scale)))
+                for x in numpy.arange(-limit, limit + 1,
+                    dtype=numpy.float64).tolist()])
+        newelo1 = elo1 + k * (outcome[start:end] - expected[diff + limit])
+        # round half away from zero, like round() of Python 2
+        rounded = numpy.floor(newelo1)
+        rest = newelo1 - rounded
+        rounded += (rest > 0.5) | ((rest == 0.5) & (newelo1 >= 0.0))
+        ratings[player1Wave] = rounded
+        ratings[player2Wave] = elo2 - (rounded - elo1)
+        start = end
+    return True
+
+#: :py:func:`_replay` compiled with Numba, see :py:func:`_replayKernel`
+_compiled = []
+
+
+def _replayKernel():
+    """
+    Compiles :py:func:`_replay` with Numba on first use.
+
+    :return: the compiled function, or None if Numba is not installed
+    """
+    if not _compiled:
+        numba = optional('numba')
+        _compiled.append(numba.njit(nogil=True)(_replay)
+            if numba is not None else None)
+    return _compiled[0]
@@ -19,8 +19,12 @@ outcome:
     * 0: player 1 lost
     * 0.5: draw
     * 1: player 1 win
+
+All matches of a rating period are rated at once with :py:func:`ratePeriod`.
+It uses NumPy if it is installed.
 """
 import math
+from pychallenge.algorithms import optional
 
 #: glicko constant ( q = (ln 10) / 400 = 0.0057565 )
 q = 0.0057565
@@ -98,9 +102,9 @@ def dSquared(ratingOwn, ratingList, RDList):
     #: assert that ratingList and RDList have the same length
     assert ratingList and RDList and len(ratingList) == len(RDList)
     sum = 0.0
-    for RD in RDList:
+    for rating, RD in zip(ratingList, RDList):
         g2 = g(RD) * g(RD)
-        e = expectation(ratingOwn, ratingList[RDList.index(RD)], RD)
+        e = expectation(ratingOwn, rating, RD)
         sum += g2 * e * (1.0 - e)
 
     sum = q * q * sum
@@ -135,9 +139,9 @@ def newRating(RDOwn, ratingOwn, ratingList, RDList, outcomeList):
     factor = q / ((1.0 / (RDOwn ** 2.0)) + (1.0 / d2))
 
     sum = 0.0
-    for RD in RDList:
-        e = expectation(ratingOwn, ratingList[RDList.index(RD)], RD)
-        sum += g(RD) * (outcomeList[RDList.index(RD)] - e)
+    for rating, RD, outcome in zip(ratingList, RDList, outcomeList):
+        e = expectation(ratingOwn, rating, RD)
+        sum += g(RD) * (outcome - e)
 
     result = ratingOwn + (factor * sum)
 
@@ -164,3 +168,214 @@ def newRD(RDOwn, ratingOwn, ratingList, RDList):
     result = math.sqrt(1.0 / ((1.0 / (rd2) + (1.0 / d2))))
 
     return result
+
+
+def ratePeriod(ratingList, RDList, tList, c, player1List, player2List,
+        outcomeList):
+    """
+    Rates all matches of a rating period at once. The players are given by
+    their position in `ratingList`, `RDList` and `tList`. Each player is
+    rated against the ratings and RDs of the opponents at the beginning of
+    the period, i.e. the result does not depend on the order of the matches.
+    For each player that played in the period, this gives the same result as
+    :py:func:`newRating` and :py:func:`newRD` with the RD of
+    :py:func:`getCurrentRD`.
+
+    The matches are grouped by player once, so the time is linear in the
+    number of matches. If NumPy is installed, all players are rated with
+    array operations, see :py:func:`_ratePeriodNumpy`.
+
+    :param ratingList: the ratings of the players
+    :param RDList: the RDs of the players
+    :param tList: the number of rating periods since the last match of each
+        player, see :py:func:`getCurrentRD`
+    :param c: uncertainty over time (choosen for each game)
+    :param player1List: the position of player 1 of each match
+    :param player2List: the position of player 2 of each match
+    :param outcomeList: the outcome of each match
+    :type ratingList: list of floats
+    :type RDList: list of floats
+    :type tList: list of integers
+    :type c: float
+    :type player1List: list of integers
+    :type player2List: list of integers
+    :type outcomeList: list of floats
+    :return: the new ratings and the new RDs of all players. The values of
+        players without matches are returned unchanged.
+    :rtype: tuple of two lists of floats
+    """
+    assert len(ratingList) == len(RDList) and len(ratingList) == len(tList)
+    assert len(player1List) == len(player2List) and \
+        len(player1List) == len(outcomeList)
+    if optional('numpy') is not None:
+        return _ratePeriodNumpy(ratingList, RDList, tList, c, player1List,
+            player2List, outcomeList)
+
+    # the matches of each player: (opponent, outcome) in match order
+    games = [[] for rating in ratingList]
+    for player1, player2, outcome in zip(player1List, player2List,
+            outcomeList):
+        games[player1].append((player2, outcome))
+        games[player2].append((player1, 1.0 - outcome))
+    gList = [g(RD) for RD in RDList]
+
+    ratings = list(ratingList)
+    RDs = list(RDList)
+    for player, playerGames in enumerate(games):
+        if not playerGames:
+            continue
+        curRD = getCurrentRD(RDList[player], c, tList[player])
+        rating = ratingList[player]
+        # the sums of dSquared and newRating
+        d2Sum = 0.0
+        ratingSum = 0.0
+        for opponent, outcome in playerGames:
+            gOpp = gList[opponent]
+            e = 1 / (1.0 + (10.0 ** ((-1.0 * gOpp *
+                (rating - ratingList[opponent])) / 400.0)))
+            d2Sum += gOpp * gOpp * e * (1.0 - e)
+            ratingSum += gOpp * (outcome - e)
+        d2 = 1.0 / (q * q * d2Sum)
+        factor = q / ((1.0 / (curRD ** 2.0)) + (1.0 / d2))
+        newRating = rating + (factor * ratingSum)
+
+        # newRD uses the new rating of the player
+        d2Sum = 0.0
+        for opponent, outcome in playerGames:
+            gOpp = gList[opponent]
+            e = 1 / (1.0 + (10.0 ** ((-1.0 * gOpp *
+                (newRating - ratingList[opponent])) / 400.0)))
+            d2Sum += gOpp * gOpp * e * (1.0 - e)
+        d2 = 1.0 / (q * q * d2Sum)
+        ratings[player] = newRating
+        RDs[player] = math.sqrt(1.0 / ((1.0 / (curRD * curRD) +
+            (1.0 / d2))))
+    return ratings, RDs
+
+
+def rateHistory(ratingList, RDList, lastList, c, dateList, player1List,
+        player2List, outcomeList):
+    """
+    Rates all rating periods of a match history with :py:func:`ratePeriod`.
+    The matches must be ordered by their date, which is the number of the
+    rating period. All players of a period are rated in the order of their
+    first match in the period.
+
+    The arguments and the result can be sent to another process, e.g. to
+    rate independent shards of the players (see
+    :py:func:`pychallenge.algorithms.scheduler.shards`) in parallel.
+
+    :param ratingList: the ratings of the players
+    :param RDList: the RDs of the players
+    :param lastList: the period of the last match of each player
+    :param c: uncertainty over time (choosen for each game)
+    :param dateList: the date (rating period) of each match
+    :param player1List: the position of player 1 of each match
+    :param player2List: the position of player 2 of each match
+    :param outcomeList: the outcome of each match
+    :type ratingList: list of floats
+    :type RDList: list of floats
+    :type lastList: list of integers
+    :type c: float
+    :type dateList: list of integers
+    :type player1List: list of integers
+    :type player2List: list of integers
+    :type outcomeList: list of floats
+    :return: the new ratings, RDs and periods of the last match
+    :rtype: tuple of three lists
+    """
+    ratings = list(ratingList)
+    RDs = list(RDList)
+    lasts = list(lastList)
+    for period, players, player1s, player2s, outcomes in _periods(dateList,
+            player1List, player2List, outcomeList):
+        newRatings, newRDs = ratePeriod([ratings[p] for p in players],
+            [RDs[p] for p in players], [period - lasts[p] for p in players],
+            c, player1s, player2s, outcomes)
+        for player, rating, RD in zip(players, newRatings, newRDs):
+            ratings[player] = rating
+            RDs[player] = RD
+            lasts[player] = period
+    return ratings, RDs, lasts
+
+
+def _periods(dateList, player1List, player2List, outcomeList):
+    """
+    Splits the matches ordered by date into rating periods.
+
+    :return: a generator yielding the period, the players of the period (by
+        their first match) and the matches of the period with the positions
+        of the players in the list of the players of the period
+    """
+    start = 0
+    while start < len(dateList):
+        period = dateList[start]
+        end = start
+        players = []
+        index = {}
+        player1s = []
+        player2s = []
+        while end < len(dateList) and dateList[end] == period:
+            for player in (player1List[end], player2List[end]):
+                if player not in index:
+                    index[player] = len(players)
+                    players.append(player)
+            player1s.append(index[player1List[end]])
+            player2s.append(index[player2List[end]])
+            end += 1
+        yield period, players, player1s, player2s, outcomeList[start:end]
+        start = end
+
+
+def _ratePeriodNumpy(ratingList, RDList, tList, c, player1List, player2List,
+        outcomeList):
+    """
+    The NumPy implementation of :py:func:`ratePeriod`. Each match is split
+    into one entry per player; the sums over the entries of each player are
+    computed with :py:func:`numpy.bincount`, which adds them in match order
+    like the loops of :py:func:`dSquared` and :py:func:`newRating`. The
+    results can still differ in the last bit, since the power function of
+    NumPy may round differently than the one of Python.
+    """
+    numpy = optional('numpy')
+    n = len(ratingList)
+    rating = numpy.asarray(ratingList, dtype=numpy.float64)
+    RD = numpy.asarray(RDList, dtype=numpy.float64)
+    t = numpy.asarray(tList, dtype=numpy.float64)
+    player1 = numpy.asarray(player1List, dtype=numpy.intp)
+    player2 = numpy.asarray(player2List, dtype=numpy.intp)
+    outcome = numpy.asarray(outcomeList, dtype=numpy.float64)
+
+    # entry 2 * i is match i from the view of player 1, 2 * i + 1 from the
+    # view of player 2
+    own = numpy.column_stack((player1, player2)).ravel()
+    opponent = numpy.column_stack((player2, player1)).ravel()
+    score = numpy.column_stack((outcome, 1.0 - outcome)).ravel()
+    played = numpy.bincount(own, minlength=n) > 0
+
+    gAll = (numpy.sqrt(1.0 + ((3.0 * q * q * RD * RD) /
+        (math.pi * math.pi)))) ** -1
+    gOpp = gAll[opponent]
+    ratingOpp = rating[opponent]
+
+    def sums(ownRating):
+        e = 1 / (1.0 + (10.0 ** ((-1.0 * gOpp *
+            (ownRating[own] - ratingOpp)) / 400.0)))
+        d2Sum = numpy.bincount(own, gOpp * gOpp * e * (1.0 - e), n)
+        ratingSum = numpy.bincount(own, gOpp * (score - e), n)
+        return d2Sum, ratingSum
+
+    curRD = numpy.minimum(numpy.sqrt(RD * RD + c * c * t), 350.0)
+    d2Sum, ratingSum = sums(rating)
+    # players without matches are masked out to avoid divisions by zero
+    d2Sum[~played] = 1.0
+    d2 = 1.0 / (q * q * d2Sum)
+    factor = q / ((1.0 / (curRD ** 2.0)) + (1.0 / d2))
+    newRating = numpy.where(played, rating + (factor * ratingSum), rating)
+
+    d2Sum = sums(newRating)[0]
+    d2Sum[~played] = 1.0
+    d2 = 1.0 / (q * q * d2Sum)
+    newRD = numpy.where(played,
+        numpy.sqrt(1.0 / ((1.0 / (curRD * curRD) + (1.0 / d2)))), RD)
+    return newRating.tolist(), newRD.tolist()
@@ -19,10 +19,18 @@ outcome:
     * 0: player 1 lost
     * 0.5: draw
     * 1: player 1 win
+
+All matches of a rating period are rated at once with :py:func:`ratePeriod`.
+It uses NumPy if it is installed.
 """
 import math
+from pychallenge.algorithms import glicko, optional
+
+#: the default tau, used if the game does not define one
+tau = 0.5
 
-# tau = 0.5
+#: the maximum number of iterations of :py:func:`volatility`
+maxIterations = 100
 
 precision = 10
 
@@ -113,10 +121,10 @@ def v(muOwn, muList, phiList):
     """
     assert muList and phiList and len(muList) == len(phiList)
     sum = 0.0
-    for phi in phiList:
+    for mu, phi in zip(muList, phiList):
         g2 = g(phi) ** 2
-        sum += g2 * expectation(muOwn, muList[phiList.index(phi)], phi) * (1.0
-            - expectation(muOwn, muList[phiList.index(phi)], phi))
+        e = expectation(muOwn, mu, phi)
+        sum += g2 * e * (1.0 - e)
     result = sum ** -1
     return result
 
@@ -140,9 +148,8 @@ def delta(muOwn, muList, phiList, outcomeList):
         and len(phiList) == len(outcomeList))
     vr = v(muOwn, muList, phiList)
     sum = 0.0
-    for phi in phiList:
-        sum += g(phi) * (outcomeList[phiList.index(phi)] -
-            expectation(muOwn, muList[phiList.index(phi)], phi))
+    for mu, phi, outcome in zip(muList, phiList, outcomeList):
+        sum += g(phi) * (outcome - expectation(muOwn, mu, phi))
     return vr * sum
 
 
@@ -212,7 +219,8 @@ def h2(tau, x, phi, v, d, delta):
     return al - bl + dl
 
 
-def newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn):
+def newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn, phiOwn,
+        tau=tau):
     """
     returns updated sigma (rating volatility)
 
@@ -221,11 +229,15 @@ def newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn):
     :param phiList: list of opponents' phi
     :param outcomeList: list of match outcomes
     :param sigmaOwn: player's sigma
+    :param phiOwn: player's phi
+    :param tau: tau constant of game
     :type muOwn: float
     :type muList: list of floats
     :type phiList: list of floats
     :type outcomeList: list of floats (0, 0.5, 1)
     :type sigmaOwn: float
+    :type phiOwn: float
+    :type tau: float
     :return: updated sigma
     :rtype: float
     """
@@ -233,17 +245,63 @@ def newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn):
         and len(phiList) == len(outcomeList))
     deltar = delta(muOwn, muList, phiList, outcomeList)
     vr = v(muOwn, muList, phiList)
+    return volatility(phiOwn, vr, deltar, sigmaOwn, tau)
+
+
+def volatility(phiOwn, variance, delta, sigmaOwn, tau=tau):
+    """
+    Solves the volatility equation of Glicko-2 with the Illinois algorithm,
+    a variant of regula falsi, up to :py:func:`getPrecision`.
+
+    :param phiOwn: player's phi
+    :param variance: estimated variance of player, see :py:func:`v`
+    :param delta: estimated improvement, see :py:func:`delta`
+    :param sigmaOwn: player's sigma
+    :param tau: tau constant of game
+    :type phiOwn: float
+    :type variance: float
+    :type delta: float
+    :type sigmaOwn: float
+    :type tau: float
+    :return: updated sigma
+    :rtype: float
+    """
+    epsilon = getPrecision()
     a = math.log(sigmaOwn ** 2)
-    x = a
-    xi = 0.0
-    # repeat until x and xi are close
-    while getPrecision() >= math.fabs(x - xi):
-        dr = phi ** 2 + vr + math.exp(x)
-        h1r = h1(x, a, tau, dr, deltar)
-        h2r = h2(tau, x, phiOwn, vr, dr, deltar)
-        xi = x
-        x = x - (h1r / h2r)
-    return math.exp(x / 2)
+    delta2 = delta ** 2
+    phi2v = phiOwn ** 2 + variance
+    tau2 = tau ** 2
+
+    def f(x):
+        ex = math.exp(x)
+        return (ex * (delta2 - phi2v - ex)) / (2.0 * (phi2v + ex) ** 2) - \
+            ((x - a) / tau2)
+
+    # the initial interval [A, B] (or [B, A]) that contains the root
+    A = a
+    if delta2 > phi2v:
+        B = math.log(delta2 - phi2v)
+    else:
+        k = 1
+        while f(a - k * tau) < 0:
+            k += 1
+        B = a - k * tau
+    fA = f(A)
+    fB = f(B)
+
+    iterations = 0
+    while math.fabs(B - A) > epsilon and iterations < maxIterations:
+        C = A + ((A - B) * fA) / (fB - fA)
+        fC = f(C)
+        if fC * fB < 0:
+            A = B
+            fA = fB
+        else:
+            fA = fA / 2.0
+        B = C
+        fB = fC
+        iterations += 1
+    return math.exp(A / 2.0)
 
 
 def phiStar(phiOwn, sigmaOwn):
@@ -301,14 +359,255 @@ def newMu(muOwn, newPhi, muList, phiList, outcomeList):
     assert (muList and phiList and outcomeList and len(muList) == len(phiList)
         and len(phiList) == len(outcomeList))
     sum = 0.0
-    for phi in phiList:
-        sum += (g(phi) * (outcomeList[phiList.index(phi)] -
-            expectation(muOwn, muList[phiList.index(phi)], phi)))
+    for mu, phi, outcome in zip(muList, phiList, outcomeList):
+        sum += (g(phi) * (outcome - expectation(muOwn, mu, phi)))
     e = newPhi ** 2 * sum
     mu = muOwn + e
     return mu
 
 
+def ratePeriod(ratingList, RDList, sigmaList, tList, tau, player1List,
+        player2List, outcomeList):
+    """
+    Rates all matches of a rating period at once. The players are given by
+    their position in `ratingList`, `RDList`, `sigmaList` and `tList`. All
+    players are rated against the values of their opponents at the
+    beginning of the period, so the result does not depend on the order of
+    the matches.
+
+    If a player did not play for more than one period, the phi is increased
+    by the volatility for each missed period (see :py:func:`phiStar`), but
+    the RD does not exceed 350. For each player that played in the period,
+    the result is the same as computing :py:func:`newSigma`,
+    :py:func:`newPhi` and :py:func:`newMu` for the player.
+
+    The matches are grouped by player once, so the time is linear in the
+    number of matches. If NumPy is installed, all players are rated with
+    array operations, and the volatility equation is solved for all
+    players at once, see :py:func:`_ratePeriodNumpy`.
+
+    :param ratingList: the Glicko ratings of the players
+    :param RDList: the Glicko RDs of the players
+    :param sigmaList: the volatilities of the players
+    :param tList: the number of rating periods since the last match of each
+        player
+    :param tau: tau constant of game
+    :param player1List: the position of player 1 of each match
+    :param player2List: the position of player 2 of each match
+    :param outcomeList: the outcome of each match
+    :type ratingList: list of floats
+    :type RDList: list of floats
+    :type sigmaList: list of floats
+    :type tList: list of integers
+    :type tau: float
+    :type player1List: list of integers
+    :type player2List: list of integers
+    :type outcomeList: list of floats
+    :return: the new Glicko ratings, the new Glicko RDs and the new
+        volatilities of all players. The values of players without matches
+        are returned unchanged.
+    :rtype: tuple of three lists of floats
+    """
+    assert len(ratingList) == len(RDList) and \
+        len(ratingList) == len(sigmaList) and len(ratingList) == len(tList)
+    assert len(player1List) == len(player2List) and \
+        len(player1List) == len(outcomeList)
+    if optional('numpy') is not None:
+        return _ratePeriodNumpy(ratingList, RDList, sigmaList, tList, tau,
+            player1List, player2List, outcomeList)
+
+    # the matches of each player: (opponent, outcome) in match order
+    games = [[] for rating in ratingList]
+    for player1, player2, outcome in zip(player1List, player2List,
+            outcomeList):
+        games[player1].append((player2, outcome))
+        games[player2].append((player1, 1.0 - outcome))
+    maxPhi = glickoToGlicko2RD(350.0)
+    muList = [glickoToGlicko2rating(rating) for rating in ratingList]
+    phiList = [min(math.sqrt(glickoToGlicko2RD(RD) ** 2 +
+        max(t - 1, 0) * sigma ** 2), maxPhi)
+        for RD, sigma, t in zip(RDList, sigmaList, tList)]
+
+    ratings = list(ratingList)
+    RDs = list(RDList)
+    sigmas = list(sigmaList)
+    for player, playerGames in enumerate(games):
+        if not playerGames:
+            continue
+        opponentMus = [muList[opponent] for opponent, outcome in playerGames]
+        opponentPhis = [phiList[opponent]
+            for opponent, outcome in playerGames]
+        outcomes = [outcome for opponent, outcome in playerGames]
+        mu = muList[player]
+        variance = v(mu, opponentMus, opponentPhis)
+        sigma = volatility(phiList[player], variance,
+            delta(mu, opponentMus, opponentPhis, outcomes), sigmaList[player],
+            tau)
+        phi = newPhi(phiList[player], sigma, variance)
+        ratings[player] = glicko2ToGlickoMu(newMu(mu, phi, opponentMus,
+            opponentPhis, outcomes))
+        RDs[player] = glicko2ToGlickoPhi(phi)
+        sigmas[player] = sigma
+    return ratings, RDs, sigmas
+
+
+def rateHistory(ratingList, RDList, sigmaList, lastList, tau, dateList,
+        player1List, player2List, outcomeList):
+    """
+    Rates all rating periods of a match history with :py:func:`ratePeriod`.
+    The matches must be ordered by their date, which is the number of the
+    rating period, see :py:func:`pychallenge.algorithms.glicko.rateHistory`.
+
+    :param ratingList: the Glicko ratings of the players
+    :param RDList: the Glicko RDs of the players
+    :param sigmaList: the volatilities of the players
+    :param lastList: the period of the last match of each player
+    :param tau: tau constant of game
+    :param dateList: the date (rating period) of each match
+    :param player1List: the position of player 1 of each match
+    :param player2List: the position of player 2 of each match
+    :param outcomeList: the outcome of each match
+    :type ratingList: list of floats
+    :type RDList: list of floats
+    :type sigmaList: list of floats
+    :type lastList: list of integers
+    :type tau: float
+    :type dateList: list of integers
+    :type player1List: list of integers
+    :type player2List: list of integers
+    :type outcomeList: list of floats
+    :return: the new ratings, RDs, volatilities and periods of the last
+        match
+    :rtype: tuple of four lists
+    """
+    ratings = list(ratingList)
+    RDs = list(RDList)
+    sigmas = list(sigmaList)
+    lasts = list(lastList)
+    for period, players, player1s, player2s, outcomes in glicko._periods(
+            dateList, player1List, player2List, outcomeList):
+        newRatings, newRDs, newSigmas = ratePeriod(
+            [ratings[p] for p in players], [RDs[p] for p in players],
+            [sigmas[p] for p in players], [period - lasts[p] for p in players],
+            tau, player1s, player2s, outcomes)
+        for player, rating, RD, sigma in zip(players, newRatings, newRDs,
+                newSigmas):
+            ratings[player] = rating
+            RDs[player] = RD
+            sigmas[player] = sigma
+            lasts[player] = period
+    return ratings, RDs, sigmas, lasts
+
+
+def _ratePeriodNumpy(ratingList, RDList, sigmaList, tList, tau, player1List,
+        player2List, outcomeList):
+    """
+    The NumPy implementation of :py:func:`ratePeriod`. Each match is split
+    into one entry per player; the sums over the entries of each player are
+    computed with :py:func:`numpy.bincount`. The volatility equation is
+    solved with :py:func:`_volatilityNumpy`.
+    """
+    numpy = optional('numpy')
+    n = len(ratingList)
+    RD = numpy.asarray(RDList, dtype=numpy.float64)
+    sigma = numpy.asarray(sigmaList, dtype=numpy.float64)
+    t = numpy.asarray(tList, dtype=numpy.float64)
+    mu = glickoToGlicko2rating(numpy.asarray(ratingList,
+        dtype=numpy.float64))
+    phi = numpy.minimum(numpy.sqrt(glickoToGlicko2RD(RD) ** 2 +
+        numpy.maximum(t - 1, 0) * sigma ** 2), glickoToGlicko2RD(350.0))
+    player1 = numpy.asarray(player1List, dtype=numpy.intp)
+    player2 = numpy.asarray(player2List, dtype=numpy.intp)
+    outcome = numpy.asarray(outcomeList, dtype=numpy.float64)
+
+    # entry 2 * i is match i from the view of player 1, 2 * i + 1 from the
+    # view of player 2
+    own = numpy.column_stack((player1, player2)).ravel()
+    opponent = numpy.column_stack((player2, player1)).ravel()
+    score = numpy.column_stack((outcome, 1.0 - outcome)).ravel()
+    played = numpy.bincount(own, minlength=n) > 0
+
+    gOpp = ((numpy.sqrt(1 + ((3 * (phi ** 2)) / (math.pi * math.pi))))
+        ** -1)[opponent]
+    e = (1.0 + numpy.exp(-gOpp * (mu[own] - mu[opponent]))) ** -1
+    vSum = numpy.bincount(own, gOpp ** 2 * e * (1.0 - e), n)
+    improvement = numpy.bincount(own, gOpp * (score - e), n)
+    # players without matches are masked out to avoid divisions by zero
+    vSum[~played] = 1.0
+    variance = vSum ** -1
+
+    newSigma = numpy.where(played, _volatilityNumpy(phi, variance,
+        variance * improvement, sigma, tau), sigma)
+    phiStar = numpy.sqrt(phi ** 2 + newSigma ** 2)
+    newPhi = numpy.sqrt((1 / phiStar ** 2) + (1 / variance)) ** -1
+    newMu = mu + newPhi ** 2 * improvement
+
+    ratings = numpy.where(played, glicko2ToGlickoMu(newMu), ratingList)
+    RDs = numpy.where(played, glicko2ToGlickoPhi(newPhi), RD)
+    return ratings.tolist(), RDs.tolist(), newSigma.tolist()
+
+
+def _volatilityNumpy(phi, variance, delta, sigma, tau):
+    """
+    Solves the volatility equation for all players at once with the
+    Illinois algorithm, see :py:func:`volatility`. Each player leaves the
+    iteration as soon as his interval is small enough.
+
+    :param phi: the phis of the players
+    :param variance: the estimated variances of the players
+    :param delta: the estimated improvements of the players
+    :param sigma: the volatilities of the players
+    :param tau: tau constant of game
+    :type phi: :py:class:`numpy.ndarray`
+    :type variance: :py:class:`numpy.ndarray`
+    :type delta: :py:class:`numpy.ndarray`
+    :type sigma: :py:class:`numpy.ndarray`
+    :type tau: float
+    :return: the updated sigmas
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    numpy = optional('numpy')
+    epsilon = getPrecision()
+    a = numpy.log(sigma ** 2)
+    delta2 = delta ** 2
+    phi2v = phi ** 2 + variance
+    tau2 = tau ** 2
+
+    def f(x):
+        ex = numpy.exp(x)
+        return (ex * (delta2 - phi2v - ex)) / (2.0 * (phi2v + ex) ** 2) - \
+            ((x - a) / tau2)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # the initial interval [A, B] (or [B, A]) that contains the root
+        A = a.copy()
+        large = delta2 > phi2v
+        B = numpy.where(large, numpy.log(numpy.where(large,
+            delta2 - phi2v, 1.0)), a - tau)
+        k = 1
+        search = ~large & (f(B) < 0)
+        while search.any():
+            k += 1
+            B = numpy.where(search, a - k * tau, B)
+            search &= f(B) < 0
+        fA = f(A)
+        fB = f(B)
+
+        active = numpy.abs(B - A) > epsilon
+        iterations = 0
+        while active.any() and iterations < maxIterations:
+            C = A + ((A - B) * fA) / (fB - fA)
+            fC = f(C)
+            swap = fC * fB < 0
+            A = numpy.where(active & swap, B, A)
+            fA = numpy.where(active, numpy.where(swap, fB, fA / 2.0), fA)
+            B = numpy.where(active, C, B)
+            fB = numpy.where(active, fC, fB)
+            active &= numpy.abs(B - A) > epsilon
+            iterations += 1
+    return numpy.exp(A / 2.0)
+
+
 ############################################################################
 # for testing purposes only                                                #
 ############################################################################
@@ -383,7 +682,8 @@ def testGlicko2():
     # new sigma
     print "sigma"
     print "expected 0.05999"
-    nsigma = newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn)
+    nsigma = newSigma(muOwn, muList, phiList, outcomeList, sigmaOwn, phiOwn,
+        tau)
     print str(nsigma)
 
     print ""
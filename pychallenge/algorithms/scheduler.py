@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+splits an ordered list of matches into waves or independent shards
+
+A match only depends on the earlier matches of its two players. The matches
+are assigned to waves, so that
+
+    * no player plays twice in the same wave, and
+    * each match is in a later wave than the previous match of each of its
+      players.
+
+Thus, rating the waves one after another, and all matches of a wave at
+once, gives the same result as rating the matches one after another. The
+matches of a wave can be rated with array operations.
+
+example (players a, b, c, d)::
+
+    match:  0      1      2      3
+    pair:   (a, b) (c, d) (a, c) (b, d)
+    wave:   0      0      1      1
+
+Players who never meet, directly or through other players, have
+independent ratings. :py:func:`shards` groups the connected components of
+the players into shards that can be rated in parallel.
+"""
+import heapq
+
+
+def waveLevels(player1List, player2List, count=None):
+    """
+    Computes the wave of each match. The wave of a match is one more than
+    the latest wave of the previous matches of its players.
+
+    :param player1List: player 1 of each match, in match order
+    :param player2List: player 2 of each match, in match order
+    :param count: If the players are given by their position (0 to
+        `count` - 1), the number of players. This is considerably faster.
+    :type player1List: list
+    :type player2List: list
+    :type count: Integer
+    :return: the wave of each match, starting with 0
+    :rtype: list of integers
+    """
+    assert len(player1List) == len(player2List)
+    if count is None:
+        # player --> wave of the latest match of the player
+        last = {}
+        for player in player1List:
+            last[player] = -1
+        for player in player2List:
+            last[player] = -1
+    else:
+        last = [-1] * count
+    levels = []
+    append = levels.append
+    for player1, player2 in zip(player1List, player2List):
+        level1 = last[player1]
+        level2 = last[player2]
+        level = (level1 if level1 > level2 else level2) + 1
+        last[player1] = level
+        last[player2] = level
+        append(level)
+    return levels
+
+
+def waves(player1List, player2List, count=None):
+    """
+    Splits the matches into waves, see :py:func:`waveLevels`.
+
+    :param player1List: player 1 of each match, in match order
+    :param player2List: player 2 of each match, in match order
+    :param count: the number of players, see :py:func:`waveLevels`
+    :type player1List: list
+    :type player2List: list
+    :type count: Integer
+    :return: the positions of the matches of each wave, in match order
+    :rtype: list of lists of integers
+    """
+    result = []
+    for match, level in enumerate(waveLevels(player1List, player2List,
+            count)):
+        if level == len(result):
+            result.append([])
+        result[level].append(match)
+    return result
+
+
+def components(pairs, count):
+    """
+    Finds the connected components of the players with union-find: two
+    players are in the same component if they played against each other,
+    directly or through other players. The matches are read once and in any
+    order, so they can be streamed from the database.
+
+    :param pairs: the positions (player 1, player 2) of the players of each
+        match
+    :param count: the number of players
+    :type pairs: iterable of tuples
+    :type count: Integer
+    :return: the component of each player, given by the position of one of
+        its players, and the number of matches of each component
+    :rtype: tuple (list of integers, dictionary)
+    """
+    parent = list(range(count))
+    size = [1] * count
+
+    def find(player):
+        while parent[player] != player:
+            # path halving
+            parent[player] = parent[parent[player]]
+            player = parent[player]
+        return player
+
+    # player --> number of matches of the component of the player; only
+    # valid for the roots
+    matches = [0] * count
+    for player1, player2 in pairs:
+        root1 = find(player1)
+        root2 = find(player2)
+        if root1 != root2:
+            if size[root1] < size[root2]:
+                root1, root2 = root2, root1
+            parent[root2] = root1
+            size[root1] += size[root2]
+            matches[root1] += matches[root2]
+        matches[root1] += 1
+    labels = [find(player) for player in range(count)]
+    weights = {}
+    for label in labels:
+        if matches[label]:
+            weights[label] = matches[label]
+    return labels, weights
+
+
+def shards(pairs, count, shardCount):
+    """
+    Groups the connected components of the players (see
+    :py:func:`components`) into at most `shardCount` shards with about the
+    same number of matches. The largest components are assigned first,
+    each to the shard with the fewest matches so far. Players without
+    matches are not part of any shard.
+
+    :param pairs: the positions (player 1, player 2) of the players of each
+        match
+    :param count: the number of players
+    :param shardCount: the maximum number of shards
+    :type pairs: iterable of tuples
+    :type count: Integer
+    :type shardCount: Integer
+    :return: the shard of each player (-1 for players without matches) and
+        the number of shards. Each shard has at least one match.
+    :rtype: tuple (list of integers, Integer)
+    """
+    labels, weights = components(pairs, count)
+    shardCount = min(shardCount, len(weights))
+
+    # (number of matches, shard) of the shards
+    loads = [(0, shard) for shard in range(shardCount)]
+    shardOf = {}
+    for label in sorted(weights, key=lambda label: (-weights[label], label)):
+        load, shard = heapq.heappop(loads)
+        shardOf[label] = shard
+        heapq.heappush(loads, (load + weights[label], shard))
+    return [shardOf.get(label, -1) for label in labels], shardCount
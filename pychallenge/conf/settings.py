@@ -7,18 +7,55 @@ SETTINGS = {
     'BASE_PATH': BASE_PATH,
     'DATABASE': join(BASE_PATH, '..', '..', 'data.db'),
     'DEBUG': False,
+    # If True, each command prints a summary of the executed statements
+    'PROFILE': False,
+    # Statements that take at least this number of seconds are logged
+    # together with their query plan. None disables the slow query log.
+    'SLOW_QUERY_TIME': None,
+    # The number of query results kept in memory by QuerySet.get() and
+    # QuerySet.all(). 0 disables the cache. Only useful for long running
+    # processes that repeat the same queries.
+    'QUERY_CACHE_SIZE': 0,
+    # The number of processes that rate independent groups of players in
+    # parallel during update. None uses one process per CPU, 1 rates all
+    # matches in this process.
+    'PROCESSES': None,
+    # The SQLite pragmas applied when the connection is opened, see
+    # http://www.sqlite.org/pragma.html. The page size only takes effect for
+    # new databases.
+    'PRAGMAS': {
+        'page_size': 4096,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # a negative cache size is given in KiB
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+    # The pragmas that are changed for the duration of bulk operations like
+    # import-results and update. These trade durability for throughput: if
+    # the machine crashes during the run, the database may be corrupted.
+    'BULK_PRAGMAS': {
+        'synchronous': 'OFF',
+        'cache_size': -524288,
+        'temp_store': 'MEMORY',
+    },
 }
 
 
 def load_settings():
     """
     :func:`load_settings` initializes the default settings and reads
-    the user settings as well.
+    the user settings as well. Dictionaries like ``PRAGMAS`` are updated with
+    the user settings, so single entries can be overridden.
     """
     try:
         from pychallenge import usersettings as us
         for s in us.__all__:
-            SETTINGS[s] = getattr(us, s)
+            if isinstance(SETTINGS.get(s, None), dict):
+                SETTINGS[s].update(getattr(us, s))
+            else:
+                SETTINGS[s] = getattr(us, s)
     except ImportError:
         pass
 
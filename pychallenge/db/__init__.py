@@ -1,13 +1,49 @@
 # -*- coding: utf-8 -*-
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pychallenge.conf import settings
+from pychallenge.db.cache import QueryCache
+from pychallenge.db.profiler import Profiler, ProfilingCursor
 
 
 """
 The :py:module:`pychallenge.db` module provides a connection and
-connection-cursor object to access the database
+connection-cursor object to access the database. The connection is opened
+lazily on first use, so importing pychallenge does not touch the database.
+
+SQLite connections must not be shared between threads, so each thread gets
+its own connection and cursor.
+
+If ``SETTINGS['QUERY_CACHE_SIZE']`` is set, the results of
+:py:func:`pychallenge.db.models.QuerySet.get` and
+:py:func:`pychallenge.db.models.QuerySet.all` are cached (see
+:py:func:`get_cache`). The cache is shared by all threads and invalidated by
+the writes of this process; changes made by other processes are not seen
+until the cached results are evicted or :py:func:`clear_cache` is called.
 """
 
+#: Holds the connection and the cursor of the current thread, see
+#: :py:func:`get_connection` and :py:func:`get_cursor`
+_local = threading.local()
+
+#: Incremented by :py:func:`set_database`; connections of an older generation
+#: are reopened on their next use
+_generation = 0
+
+#: The active :py:class:`pychallenge.db.profiler.Profiler`, see
+#: :py:func:`start_profiling`
+_profiler = None
+
+#: The :py:class:`pychallenge.db.cache.QueryCache`, see :py:func:`get_cache`
+_cache = None
+
+#: The pragmas that can be configured, in the order they are applied. The
+#: page size must be set before the journal mode is switched to WAL.
+PRAGMAS = ['page_size', 'journal_mode', 'synchronous', 'cache_size',
+    'mmap_size', 'temp_store']
+
 
 def dict_factory(cursor, row):
     d = {}
@@ -15,10 +51,410 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-#: This is the connection object to acces the SQLite database
-connection = sqlite3.connect(settings.SETTINGS['DATABASE'])
-#: The row_factory allows us to access the fields via their name
-connection.row_factory = dict_factory
 
-#: This is the current cursor object for the session
-db = connection.cursor()
+def get_connection():
+    """
+    Opens the connection of the current thread to ``SETTINGS['DATABASE']``
+    on the first call.
+
+    :return: the connection object to access the SQLite database
+    :rtype: :py:class:`sqlite3.Connection`
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.generation != _generation:
+        close()
+        connection = None
+    if connection is None:
+        connection = sqlite3.connect(settings.SETTINGS['DATABASE'])
+        # The row_factory allows us to access the fields via their name
+        connection.row_factory = dict_factory
+        set_pragmas(settings.SETTINGS['PRAGMAS'], connection)
+        _local.connection = connection
+        _local.generation = _generation
+    return connection
+
+
+def get_cursor():
+    """
+    :return: the cursor object for the session of the current thread
+    :rtype: :py:class:`sqlite3.Cursor`
+    """
+    connection = get_connection()
+    if _profiler is not None:
+        cursor = getattr(_local, 'profiling_cursor', None)
+        if cursor is None or cursor.profiler is not _profiler:
+            cursor = _local.profiling_cursor = new_cursor()
+        return cursor
+    cursor = getattr(_local, 'cursor', None)
+    if cursor is None:
+        cursor = _local.cursor = connection.cursor()
+    return cursor
+
+
+def new_cursor(model=None):
+    """
+    :param model: the model that uses the cursor, see :py:func:`execute`
+    :type model: :py:class:`pychallenge.db.models.Model`
+    :return: a new cursor of the connection of the current thread. While
+        profiling, this is a
+        :py:class:`pychallenge.db.profiler.ProfilingCursor`.
+    :rtype: :py:class:`sqlite3.Cursor`
+    """
+    connection = get_connection()
+    if _profiler is None:
+        return connection.cursor()
+    cursor = connection.cursor(ProfilingCursor)
+    cursor.profiler = _profiler
+    cursor.model = model
+    return cursor
+
+
+def close():
+    """
+    Closes the connection of the current thread. The next database access
+    opens a new one.
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        connection.close()
+    _local.connection = _local.cursor = _local.profiling_cursor = None
+
+
+def start_profiling(slow_query_time=None, out=None):
+    """
+    Starts measuring all statements of all threads. Only the cursors created
+    afterwards are measured.
+
+    :param slow_query_time: Statements that take at least this number of
+        seconds are logged together with their query plan
+    :type slow_query_time: Float
+    :param out: The stream for the slow query log, defaults to stderr
+    :type out: file
+    :return: the new profiler
+    :rtype: :py:class:`pychallenge.db.profiler.Profiler`
+    """
+    global _profiler
+    _profiler = Profiler(slow_query_time, out)
+    return _profiler
+
+
+def stop_profiling():
+    """
+    Stops measuring the statements.
+
+    :return: the profiler with the collected statistics, or None
+    :rtype: :py:class:`pychallenge.db.profiler.Profiler`
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_cache(tables=None):
+    """
+    Returns the query result cache. It is created on the first call with
+    ``SETTINGS['QUERY_CACHE_SIZE']`` entries.
+
+    :param tables: the names of the tables read by a query
+    :type tables: list
+    :return: the cache or None if caching is disabled. None is also returned
+        if the current thread wrote one of `tables` and did not commit yet:
+        it must see its own changes, and they must not be cached for the
+        other threads before they are committed.
+    :rtype: :py:class:`pychallenge.db.cache.QueryCache`
+    """
+    global _cache
+    if _cache is None:
+        size = settings.SETTINGS.get('QUERY_CACHE_SIZE', 0)
+        if not size:
+            return None
+        _cache = QueryCache(size)
+    if tables is not None:
+        written = getattr(_local, 'written', None)
+        if written and (None in written or not written.isdisjoint(tables)):
+            return None
+    return _cache
+
+
+def clear_cache():
+    """
+    Removes all cached query results, e.g. after another process changed the
+    database.
+    """
+    if _cache is not None:
+        _cache.clear()
+
+
+def _written(statement, model):
+    """
+    Invalidates the cached results of the table of `model` if `statement`
+    changes data. Without a model, all cached results are invalidated. The
+    table is invalidated again when the changes are committed or rolled
+    back, see :py:func:`_flush_written`.
+    """
+    if _cache is None or statement.lstrip()[:6].upper() == "SELECT":
+        return
+    table = model._name if model is not None else None
+    written = getattr(_local, 'written', None)
+    if written is None:
+        written = _local.written = set()
+    written.add(table)
+    _cache.invalidate(None if table is None else [table])
+
+
+def _flush_written():
+    """
+    Invalidates the tables written by the current thread once more after a
+    commit or rollback. Other threads may have cached the old data of these
+    tables in the meantime.
+    """
+    written = getattr(_local, 'written', None)
+    if written and _cache is not None:
+        _cache.invalidate(None if None in written else list(written))
+    _local.written = set()
+
+
+def set_database(path):
+    """
+    Closes the current connection and uses the database `path` from now on,
+    e.g. ``':memory:'`` for tests. The connections of other threads are
+    reopened on their next use.
+
+    :param path: the path of the SQLite database
+    :type path: String
+    """
+    global _generation
+    close()
+    settings.SETTINGS['DATABASE'] = path
+    _generation += 1
+    clear_cache()
+
+
+def execute(statement, parameters=(), model=None):
+    """
+    Executes `statement` with the session cursor.
+
+    :param statement: the SQL statement
+    :param parameters: the parameters of the statement
+    :param model: the model executing the statement, used for profiling
+    :type statement: String
+    :type parameters: dictionary or sequence
+    :type model: :py:class:`pychallenge.db.models.Model`
+    :return: the session cursor
+    """
+    cursor = get_cursor()
+    if _profiler is not None:
+        cursor.model = model
+    _written(statement, model)
+    cursor = cursor.execute(statement, parameters)
+    _batch_commit()
+    return cursor
+
+
+def executemany(statement, seq_of_parameters, model=None):
+    """
+    Executes `statement` for each parameter set with the session cursor.
+
+    :param statement: the SQL statement
+    :param seq_of_parameters: the parameters of the statement for each row
+    :param model: the model executing the statement, used for profiling
+    :type statement: String
+    :type seq_of_parameters: iterable
+    :type model: :py:class:`pychallenge.db.models.Model`
+    :return: the session cursor
+    """
+    cursor = get_cursor()
+    if _profiler is not None:
+        cursor.model = model
+    _written(statement, model)
+    cursor = cursor.executemany(statement, seq_of_parameters)
+    _batch_commit()
+    return cursor
+
+
+def commit():
+    """
+    This function forces a commit of all data within the current connection.
+    Within a :py:func:`transaction`, this function does nothing; the data is
+    committed when the transaction ends.
+    """
+    if in_transaction():
+        return
+    get_connection().commit()
+    _flush_written()
+
+
+def in_transaction():
+    """
+    :return: `True` if the current thread is within a :py:func:`transaction`
+    :rtype: Boolean
+    """
+    return getattr(_local, 'depth', 0) > 0
+
+
+@contextmanager
+def transaction(commit_every=None):
+    """
+    Context manager that runs the enclosed statements in a transaction. If
+    the block raises an exception, all changes of the block are rolled back,
+    otherwise they are committed at the end of the block::
+
+        >>> with transaction():
+        ...     player.save()
+        ...     rank.save()
+
+    Transactions can be nested. A nested transaction is a savepoint: if it
+    fails, only the changes of the nested block are rolled back.
+
+    Within a transaction, :py:func:`commit` and the `commit` arguments of
+    the models do nothing.
+
+    :param commit_every: If set, the outermost transaction is committed and
+        a new one is started every time `commit_every` rows have been
+        changed. This trades the all-or-nothing guarantee for a bounded
+        transaction size: a failure only rolls back the changes since the
+        last intermediate commit. It is ignored by nested transactions.
+    :type commit_every: Integer
+    """
+    connection = get_connection()
+    depth = getattr(_local, 'depth', 0)
+    savepoint = None
+    if depth == 0:
+        connection.commit()
+        # The sqlite3 module would otherwise commit implicitly before some
+        # statements, so the transaction is controlled explicitly.
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        connection.execute("BEGIN")
+        _local.commit_every = commit_every
+        _local.changes = connection.total_changes
+    else:
+        savepoint = "pychallenge_%d" % depth
+        connection.execute("SAVEPOINT %s" % savepoint)
+    _local.depth = depth + 1
+    try:
+        yield
+    except:
+        _local.depth = depth
+        try:
+            if savepoint is None:
+                connection.execute("ROLLBACK")
+            else:
+                connection.execute("ROLLBACK TO %s" % savepoint)
+                connection.execute("RELEASE %s" % savepoint)
+        except sqlite3.OperationalError:
+            # SQLite already rolled back the transaction on its own
+            pass
+        if savepoint is None:
+            _flush_written()
+        raise
+    else:
+        _local.depth = depth
+        if savepoint is None:
+            connection.execute("COMMIT")
+            _flush_written()
+        else:
+            connection.execute("RELEASE %s" % savepoint)
+    finally:
+        if savepoint is None:
+            connection.isolation_level = isolation_level
+
+#: :py:func:`atomic` is an alias for :py:func:`transaction`
+atomic = transaction
+
+
+def _batch_commit():
+    """
+    Commits the outermost transaction and starts a new one if it changed at
+    least ``commit_every`` rows, see :py:func:`transaction`. Nothing is
+    committed while a savepoint is open.
+    """
+    if getattr(_local, 'depth', 0) != 1 or not _local.commit_every:
+        return
+    connection = get_connection()
+    if connection.total_changes - _local.changes >= _local.commit_every:
+        connection.execute("COMMIT")
+        _flush_written()
+        connection.execute("BEGIN")
+        _local.changes = connection.total_changes
+
+
+def get_pragma(name):
+    """
+    :param name: the name of the pragma, one of :py:data:`PRAGMAS`
+    :type name: String
+    :return: the current value of the pragma
+    """
+    if not name in PRAGMAS:
+        raise AttributeError("Unknown pragma %s" % name)
+    row = get_connection().execute("PRAGMA %s" % name).fetchone()
+    return row.values()[0] if row else None
+
+
+def table_exists(name):
+    """
+    :param name: the name of the table
+    :type name: String
+    :return: `True` if the table exists in the database
+    :rtype: Boolean
+    """
+    return _schema_exists('table', name)
+
+
+def index_exists(name):
+    """
+    :param name: the name of the index
+    :type name: String
+    :return: `True` if the index exists in the database
+    :rtype: Boolean
+    """
+    return _schema_exists('index', name)
+
+
+def _schema_exists(type, name):
+    """
+    Looks up a table or an index in the schema of the database.
+    """
+    row = get_connection().execute("SELECT 1 FROM sqlite_master "
+        "WHERE type = ? AND name = ?", (type, name)).fetchone()
+    return row is not None
+
+
+def set_pragmas(pragmas, connection=None):
+    """
+    Applies the given pragmas to the connection.
+
+    :param pragmas: a dictionary pragma name --> value
+    :type pragmas: dictionary
+    :param connection: the connection, defaults to :py:func:`get_connection`
+    :type connection: :py:class:`sqlite3.Connection`
+    """
+    if connection is None:
+        connection = get_connection()
+    for name in PRAGMAS:
+        value = pragmas.get(name, None)
+        if value is None:
+            continue
+        # pragma values cannot be passed as parameters
+        if not re.match(r'^-?\w+$', str(value)):
+            raise AttributeError("Invalid value %s for pragma %s" %
+                (value, name))
+        connection.execute("PRAGMA %s = %s" % (name, value))
+
+
+@contextmanager
+def bulk_pragmas():
+    """
+    Context manager that applies ``SETTINGS['BULK_PRAGMAS']`` for bulk
+    operations and restores the previous values afterwards::
+
+        >>> with bulk_pragmas():
+        ...     import_lots_of_data()
+    """
+    bulk = settings.SETTINGS['BULK_PRAGMAS']
+    previous = dict((name, get_pragma(name)) for name in bulk)
+    set_pragmas(bulk)
+    try:
+        yield
+    finally:
+        set_pragmas(previous)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+
+"""
+The :py:mod:`pychallenge.db.cache` module provides the result cache of
+:py:func:`pychallenge.db.models.QuerySet.get` and
+:py:func:`pychallenge.db.models.QuerySet.all`, see
+:py:func:`pychallenge.db.get_cache`.
+"""
+
+
+class QueryCache(object):
+    """
+    A least recently used cache for query results. The results are stored
+    by their statement and parameters, together with the tables the query
+    reads. A write to a table removes all results of that table::
+
+        >>> cache = QueryCache(2)
+        >>> key = cache.key("SELECT ... FROM player WHERE nickname = ?", (1,))
+        >>> cache.put(key, ['player'], cache.version(['player']), result)
+        >>> cache.get(key) is result
+        True
+        >>> cache.invalidate(['player'])
+        >>> cache.get(key)
+
+    The version of the tables is taken before the query is executed and
+    passed to :py:func:`put`. If one of the tables was written in the
+    meantime, the result is not stored, since it may be outdated already.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: the maximum number of cached results
+        :type size: Integer
+        """
+        self.size = size
+        #: key --> (tables, result), the least recently used first
+        self.results = OrderedDict()
+        #: table --> set of keys of the results that read the table
+        self.tables = {}
+        #: table --> number of writes
+        self.versions = {}
+        #: number of calls of :py:func:`invalidate` for all tables
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.results)
+
+    def __repr__(self):
+        """
+        :return: This returns a string formatted cache-object
+        """
+        return '<%s %d/%d results, %d hits, %d misses>' % (
+            self.__class__.__name__, len(self.results), self.size, self.hits,
+            self.misses)
+
+    def key(self, statement, parameters):
+        """
+        :param statement: the SQL statement
+        :param parameters: the parameters of the statement
+        :type statement: String
+        :type parameters: dictionary or sequence
+        :return: the cache key of the query, or None if the parameters are
+            not hashable
+        """
+        if isinstance(parameters, dict):
+            parameters = tuple(sorted(parameters.items()))
+        else:
+            parameters = tuple(parameters)
+        try:
+            hash(parameters)
+        except TypeError:
+            return None
+        return (statement, parameters)
+
+    def get(self, key):
+        """
+        :param key: the cache key, see :py:func:`key`
+        :return: the cached result or None
+        """
+        with self.lock:
+            entry = self.results.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # re-insert as the most recently used result
+            self.results[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def version(self, tables):
+        """
+        :param tables: the names of the tables read by a query
+        :type tables: list
+        :return: the current version of `tables`, see :py:func:`put`
+        """
+        with self.lock:
+            return self._version(tables)
+
+    def put(self, key, tables, version, result):
+        """
+        Stores `result` unless one of the `tables` was written since
+        `version` was taken. If the cache is full, the least recently used
+        result is removed.
+
+        :param key: the cache key, see :py:func:`key`
+        :param tables: the names of the tables read by the query
+        :param version: the version of `tables` before the query was executed
+        :param result: the result of the query
+        :type tables: list
+        """
+        if key is None or self.size <= 0:
+            return
+        with self.lock:
+            if self._version(tables) != version:
+                return
+            self._remove(key)
+            self.results[key] = (tables, result)
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+            while len(self.results) > self.size:
+                self._remove(next(iter(self.results)))
+
+    def invalidate(self, tables=None):
+        """
+        Removes all results that read one of `tables`.
+
+        :param tables: the names of the written tables; all tables if None
+        :type tables: list
+        """
+        with self.lock:
+            if tables is None:
+                self.epoch += 1
+                tables = list(self.tables)
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+                for key in list(self.tables.pop(table, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Removes all results and resets the statistics.
+        """
+        self.invalidate()
+        with self.lock:
+            self.hits = self.misses = 0
+
+    def _version(self, tables):
+        """
+        :return: the version of `tables`. The caller must hold the lock.
+        """
+        return (self.epoch,) + tuple(self.versions.get(table, 0)
+            for table in tables)
+
+    def _remove(self, key):
+        """
+        Removes the result `key`. The caller must hold the lock.
+        """
+        entry = self.results.pop(key, None)
+        if entry is not None:
+            for table in entry[0]:
+                keys = self.tables.get(table, None)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tables[table]
@@ -63,6 +63,73 @@ class Numeric(Field):
             return None
 
 
+class Integer(Numeric):
+    """
+    This field class matches the SQLite field type "INTEGER". The values are
+    stored as Python integers.
+    """
+    def clean(self, value):
+        """
+        :param value: clean `value`
+        :type value: variable
+        :return: cleans up the value and returns the cleaned data
+        """
+        try:
+            return int(value)
+        except ValueError:
+            return None
+
+
+class Real(Numeric):
+    """
+    This field class matches the SQLite field type "REAL". The values are
+    stored as Python floats.
+    """
+    pass
+
+
+class SmallEnum(Field):
+    """
+    A field that only accepts a few numeric values, e.g. the outcome of a
+    match::
+
+        >>> outcome = SmallEnum((0, 0.5, 1))
+
+    If all choices are integers, the field matches the SQLite field type
+    "INTEGER", otherwise "REAL" and the choices are stored as floats.
+    """
+
+    def __init__(self, choices, value=None):
+        """
+        :param choices: the allowed values
+        :param value: the field value
+        :type choices: tuple
+        :type value: variable
+        """
+        self.integer = all(isinstance(c, (int, long)) for c in choices)
+        if not self.integer:
+            choices = tuple(float(c) for c in choices)
+        self.choices = choices
+        self.value = value
+
+    def clean(self, value):
+        """
+        :param value: clean `value`
+        :type value: variable
+        :return: the matching choice or None if `value` is not one of the
+            choices
+        """
+        if isinstance(value, basestring):
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+        for choice in self.choices:
+            if value == choice:
+                return choice
+        return None
+
+
 class Text(Field):
     """
     This field class matches the SQLite field type "TEXT"
@@ -86,9 +153,9 @@ class PK(Field):
             return None
 
 
-class FK(Numeric):
+class FK(Integer):
     """
-    This field class matches the SQLite field type "NUMERIC" and will be used
+    This field class matches the SQLite field type "INTEGER" and will be used
     for foreign key validation.
     """
 
@@ -105,25 +172,31 @@ class FK(Numeric):
         self.ref_field = ref_field
         self.value = self.clean(value)
 
-    def clean(self, value):
+    @property
+    def related(self):
         """
-        :param value: clean `value`
-        :type value: variable
-        :return: cleans up the value and returns the cleaned data
+        :return: the referenced object
         """
-        try:
-            return int(value)
-        except ValueError:
-            return None
+        return self.get_related(self.value)
 
     @property
-    def related(self):
+    def ref_model(self):
         """
+        :return: the model class of the foreign table
         """
-        module = __import__("pychallenge.models", fromlist=['pychallenge'])
-        ref_class = module.__dict__.get(self.ref_table)
+        # the models module imports the fields, so it is imported here
+        from pychallenge.db.models import registry
+        if self.ref_table not in registry:
+            __import__("pychallenge.models")
+        return registry[self.ref_table]
 
-        return ref_class.query().get(**{self.ref_field: self.value})
+    def get_related(self, value):
+        """
+        :param value: the foreign key value
+        :type value: Integer
+        :return: the object of the foreign table referenced by `value`
+        """
+        return self.ref_model.query().get(**{self.ref_field: value})
 
 
 class Date(Text):
@@ -141,3 +214,154 @@ class Date(Text):
             return value
         except ValueError:
             return None
+
+
+class Index(object):
+    """
+    Declares an index on one or more fields of a model. Like the fields, an
+    index is declared as class variable of the model::
+
+        >>> class Player(models.Model):
+        ...      player_id = models.PK()
+        ...      nickname = models.Text()
+        ...      nickname_idx = models.Index('nickname', unique=True)
+
+    The index is named after the table and the class variable, e.g.
+    ``player_nickname_idx``. Besides field names, an index can contain
+    arithmetic expressions of the fields, e.g. ``Index('rating - rd')``
+    (see :py:func:`pychallenge.db.query.expression`). Such an index is used
+    by queries that are ordered by the same expression.
+    """
+
+    def __init__(self, *fields, **kwargs):
+        """
+        :param fields: the names of the indexed fields or expressions
+        :param unique: if `True`, the index is a unique index
+        :type fields: String
+        :type unique: Boolean
+        """
+        if not fields:
+            raise AttributeError("An index needs at least one field")
+        self.fields = fields
+        self.unique = kwargs.pop('unique', False)
+
+    def __repr__(self):
+        """
+        :return: This returns a string formatted index-object
+        """
+        return '<%s%s (%s)>' % ("Unique " if self.unique else "",
+            str(self.__class__.__name__), ", ".join(self.fields))
+
+
+class FieldDescriptor(object):
+    """
+    The model classes replace their field definitions by instances of this
+    descriptor. The field values of a model instance are stored in a plain
+    list (see :py:class:`pychallenge.db.models.Model`); the descriptor maps
+    the field name to the position in this list.
+    """
+    __slots__ = ('name', 'index', 'field')
+
+    def __init__(self, name, index, field):
+        """
+        :param name: the field name
+        :param index: the position of the field value in the value list
+        :param field: the field definition
+        :type name: String
+        :type index: Integer
+        :type field: :py:class:`Field`
+        """
+        self.name = name
+        self.index = index
+        self.field = field
+
+    def __get__(self, instance, owner):
+        """
+        :return: the field definition if accessed on the model class, else a
+            :py:class:`BoundField` for the instance
+        """
+        if instance is None:
+            return self.field
+        return BoundField(instance, self)
+
+    def __set__(self, instance, value):
+        """
+        Assigning to a field cleans the value and stores it in the instance.
+        If the value changes, the field is marked as modified.
+        """
+        if value is not None:
+            value = self.field.clean(value)
+        values = instance._values
+        if values[self.index] != value:
+            values[self.index] = value
+            instance._set_dirty(self.name)
+
+
+class BoundField(object):
+    """
+    A light-weight view on a single field value of a model instance. It
+    provides the ``value`` attribute of :py:class:`Field`, so
+    ``instance.field.value`` works as before, but it does not hold a copy
+    of the value.
+    """
+    __slots__ = ('instance', 'descriptor')
+
+    def __init__(self, instance, descriptor):
+        """
+        :param instance: the model instance
+        :param descriptor: the descriptor of the field
+        :type instance: :py:class:`pychallenge.db.models.Model`
+        :type descriptor: :py:class:`FieldDescriptor`
+        """
+        self.instance = instance
+        self.descriptor = descriptor
+
+    def get_value(self):
+        """
+        :return: returns the value of that field
+        """
+        return self.instance._values[self.descriptor.index]
+
+    def set_value(self, value):
+        """
+        :param value: the new value, will be cleaned by the field
+        :type value: variable
+        """
+        self.descriptor.__set__(self.instance, value)
+
+    value = property(get_value, set_value)
+
+    @property
+    def related(self):
+        """
+        The referenced object is cached in the instance, so it is queried
+        only once (or not at all, see
+        :py:func:`pychallenge.db.models.QuerySet.select_related`).
+
+        :return: the referenced object (only available for :py:class:`FK`)
+        """
+        instance = self.instance
+        name = self.descriptor.name
+        value = self.value
+        if instance._related is None:
+            instance._related = {}
+        cached = instance._related.get(name, None)
+        if cached is not None and cached[0] == value:
+            return cached[1]
+        related = self.descriptor.field.get_related(value)
+        instance._related[name] = (value, related)
+        return related
+
+    def __getattr__(self, name):
+        """
+        All other attributes are looked up on the field definition.
+        """
+        return getattr(self.descriptor.field, name)
+
+    def __repr__(self):
+        """
+        :return: This returns a string formatted field-object
+        """
+        return '<%s "%s">' % (
+            str(self.descriptor.field.__class__.__name__),
+            (self.value))
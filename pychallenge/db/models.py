@@ -1,8 +1,77 @@
 # -*- coding: utf-8 -*-
-import copy
-from pychallenge.db import connection, db
-from pychallenge.db.query import Query
-from pychallenge.db.fields import Date, Field, Numeric, Text, PK, FK
+from itertools import chain, islice
+from pychallenge import db
+from pychallenge.db.query import Query, expression
+from pychallenge.db.fields import Date, Field, Numeric, Integer, Real, \
+    SmallEnum, Text, PK, FK, FieldDescriptor, Index
+
+#: All model classes by their class name. This is used to look up the models
+#: referenced by foreign keys, see
+#: :py:attr:`pychallenge.db.fields.FK.ref_model`
+registry = {}
+
+
+class ModelBase(type):
+    """
+    Metaclass for all models. The field definitions of a model are collected
+    once when the model class is created:
+
+    * ``_fields``: a dictionary field name --> field definition
+    * ``_field_names``: the sorted field names; this is the order of the
+      values in an instance and of the columns in a select statement
+    * ``_field_index``: a dictionary field name --> position of the value
+    * ``_defaults``: the default values in the order of ``_field_names``
+    * ``_pk``: the name of the primary key field or None
+    * ``_name``: the table name
+    * ``_indexes``: a dictionary index name --> index definition
+    * ``_unique_indexes``: a cache of the unique indexes found in the
+      database, see :py:func:`Model._has_unique_index`
+
+    Each field definition is replaced by a
+    :py:class:`pychallenge.db.fields.FieldDescriptor`. Model instances only
+    store a list of their values (see :py:attr:`Model.__slots__`).
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in bases:
+            fields.update(getattr(base, '_fields', {}))
+        indexes = {}
+        for base in bases:
+            indexes.update(getattr(base, '_indexes', {}))
+        for fname, ftype in attrs.items():
+            if isinstance(ftype, Field):
+                fields[fname] = attrs.pop(fname)
+            elif isinstance(ftype, Index):
+                indexes["%s_%s" % (name.lower(), fname)] = attrs.pop(fname)
+        attrs.setdefault('__slots__', ())
+
+        names = tuple(sorted(fields.keys()))
+        attrs['_fields'] = fields
+        attrs['_field_names'] = names
+        attrs['_field_index'] = dict((n, i) for i, n in enumerate(names))
+        attrs['_defaults'] = tuple(getattr(fields[n], 'value', None)
+            for n in names)
+        attrs['_pk'] = None
+        for fname in names:
+            attrs[fname] = FieldDescriptor(fname, attrs['_field_index'][fname],
+                fields[fname])
+            if isinstance(fields[fname], PK):
+                attrs['_pk'] = fname
+        for index in indexes.values():
+            for fname in index.fields:
+                if fname not in fields:
+                    try:
+                        expression(fname, names)
+                    except AttributeError:
+                        raise AttributeError("Unknown field %s in index of "
+                            "model %s" % (fname, name))
+        attrs['_indexes'] = indexes
+        attrs['_unique_indexes'] = {}
+        attrs['_name'] = name.lower()
+        cls = super(ModelBase, mcs).__new__(mcs, name, bases, attrs)
+        registry[name] = cls
+        return cls
 
 
 class Model(object):
@@ -63,7 +132,12 @@ class Model(object):
         >>> Player.query().drop()
 
     """
-    __query__ = None
+    __metaclass__ = ModelBase
+    #: ``_values`` are the field values of an instance in the order of
+    #: ``_field_names``. ``_dirty`` is the set of fields that were modified
+    #: since the instance was loaded or saved, or None for a new instance.
+    #: ``_related`` caches the objects referenced by foreign keys.
+    __slots__ = ('_values', '_dirty', '_related')
 
     def __init__(self, **kwargs):
         """
@@ -73,78 +147,370 @@ class Model(object):
             value
         :type kwargs: dictionary
         """
-        self.__meta__ = {}
-        self.__meta__['fields'] = {}
-        self.__meta__['name'] = self.__class__.__name__.lower()
-        self.__meta__['pk'] = None
-        for fname, ftype in self.__class__.__dict__.iteritems():
-            if isinstance(ftype, Field):
-                # We need :py:func:`copy.copy` here, since ``ftype`` is the
-                # same for each model instance of the same class
-                new_field = copy.copy(ftype)
-                if kwargs.get(fname, None) != None:
-                    new_field.value = kwargs.get(fname, None)
-                self._set_meta_field(fname, instance=new_field)
-                self.__dict__[fname] = new_field
-                if isinstance(new_field, PK):
-                    self.__meta__['pk'] = fname
+        cls = self.__class__
+        values = list(cls._defaults)
+        for fname, value in kwargs.iteritems():
+            index = cls._field_index.get(fname, None)
+            if index is not None and value is not None:
+                values[index] = cls._fields[fname].clean(value)
+        self._values = values
+        self._dirty = None
+        self._related = None
+
+    @classmethod
+    def _from_values(cls, values):
+        """
+        This is the fast path to create an instance from a database row. The
+        values are taken as they are, without cleaning.
+
+        :param values: the field values in the order of ``_field_names``
+        :type values: sequence
+        :return: a new instance of this model
+        """
+        instance = cls.__new__(cls)
+        instance._values = list(values)
+        instance._dirty = set()
+        instance._related = None
+        return instance
+
+    @classmethod
+    def _row_factory(cls, columns):
+        """
+        :param columns: The column names of the rows
+        :type columns: tuple
+        :return: a function that converts a row into an instance
+        """
+        if columns == cls._field_names:
+            return cls._from_values
+        positions = [columns.index(n) if n in columns else None
+            for n in cls._field_names]
+
+        def convert(row):
+            return cls._from_values([row[i] if i is not None else None
+                for i in positions])
+        return convert
+
+    @classmethod
+    def _cursor(cls):
+        """
+        :return: a new cursor that returns the rows as plain tuples
+        """
+        cursor = db.new_cursor(cls)
+        cursor.row_factory = None
+        return cursor
 
     @property
     def pk(self):
         """
         :return: None if there is no PK, else the name of the PK-field
         """
-        return self.__meta__['pk']
+        return self._pk
+
+    def __getitem__(self, name):
+        """
+        Fast access to the plain value of the field `name`, i.e.
+        ``instance['value']`` is the same as ``instance.value.value``.
+
+        :param name: The name of the referred field
+        :type name: String
+        """
+        return self._values[self._field_index[name]]
+
+    def __setitem__(self, name, value):
+        """
+        Fast assignment of a plain value to the field `name`. In contrast to
+        ``instance.field = value``, the value is *not* cleaned.
+
+        :param name: The name of the referred field
+        :param value: The value that will be stored
+        :type name: String
+        :type value: variable
+        """
+        index = self._field_index[name]
+        if self._values[index] != value:
+            self._values[index] = value
+            self._set_dirty(name)
+
+    def _set_dirty(self, name):
+        """
+        Marks the field `name` as modified.
+
+        :param name: The name of the modified field
+        :type name: String
+        """
+        if self._dirty is not None:
+            self._dirty.add(name)
+
+    def is_dirty(self, fields=None):
+        """
+        :param fields: Only check these field names; all fields if None
+        :type fields: list
+        :return: `True` if the instance was never saved or if one of the
+            `fields` was modified since it was loaded or saved
+        :rtype: Boolean
+        """
+        if self._dirty is None:
+            return True
+        if fields is None:
+            return bool(self._dirty)
+        return not self._dirty.isdisjoint(fields)
+
+    def _as_dict(self):
+        """
+        :return: a dictionary field name --> value
+        """
+        return dict(zip(self._field_names, self._values))
 
     @classmethod
-    def all(cls, **kwargs):
+    def bulk_create(cls, iterable, batch_size=1000, commit=True,
+                    ignore_conflicts=False):
         """
-        This function returns all objects that match all performed
-        (:py:func:`filter`) queries. If there are no results,
-        :py:func:`all` returns an empty list.
+        Stores all model instances of `iterable` in the database. In contrast
+        to calling :py:func:`save` for each instance, the INSERT statement is
+        only rendered once and the rows are passed to the database in chunks
+        of `batch_size` rows using :py:meth:`sqlite3.Cursor.executemany`.
 
-        :param kwargs: Any type of filter query (see :py:func:`filter`)
-        :return: A list of instances or an empty list if there are no matching
-        :rtype: list
+        The primary keys of the new rows are *not* written back to the
+        instances. If the first instance already has a primary key value, the
+        primary key column is inserted as well. In that case, all instances
+        must have a primary key value.
+
+        :param iterable: Any iterable (e.g. a generator) of model instances
+        :type iterable: iterable
+        :param batch_size: The number of rows passed to the database at once
+        :type batch_size: Integer
+        :param commit: If `True` (default), the rows are committed after the
+            last chunk has been inserted.
+        :type commit: Boolean
+        :param ignore_conflicts: If `True`, rows that violate a unique index
+            are skipped (``INSERT OR IGNORE``).
+        :type ignore_conflicts: Boolean
+        :return: The number of passed rows
+        :rtype: Integer
         """
-        cls.__query__ = cls.__query__.filter(**kwargs)
-        fields = [f for f, t in cls.__dict__.items() if isinstance(t, Field)]
-        fields.sort()
+        instances = iter(iterable)
+        first = next(instances, None)
+        if first is None:
+            return 0
 
-        ret = cls.__query__.run()
-        if ret:
-            statement, values = ret
-            db.execute(statement, values)
-            result = []
-            for row in db:
-                instance = cls(**row)
-                result.append(copy.copy(instance))
-            return result if len(result) > 0 else []
-        return []
+        pk = cls._pk
+        __query__ = Query(Query.QTYPE_INSERT, cls._fields,
+                        table=cls._name,
+                        pk=pk,
+                        with_pk=bool(pk and first[pk]),
+                        ignore_conflicts=ignore_conflicts)
+        ret = __query__.run()
+        if not ret:
+            return 0
+        statement, values = ret
+        positions = [(name, cls._field_index[name]) for name in values.keys()]
+
+        def row(instance):
+            values = instance._values
+            return dict((name, values[i]) for name, i in positions)
+
+        rows = (row(instance) for instance in chain([first], instances))
+        count = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            db.executemany(statement, batch, model=cls)
+            count += len(batch)
+        if commit:
+            db.commit()
+        return count
+
+    @classmethod
+    def bulk_update(cls, iterable, fields=None, batch_size=1000,
+                    commit=True):
+        """
+        Writes the `fields` of all model instances of `iterable` to the
+        database. Like :py:func:`bulk_create`, the UPDATE statement is only
+        rendered once and the rows are passed to the database in chunks of
+        `batch_size` rows. Instances where none of the `fields` were modified
+        (see :py:func:`is_dirty`) are skipped.
+
+        :param iterable: Any iterable of model instances with a primary key
+        :type iterable: iterable
+        :param fields: The names of the fields to update; all fields if None
+        :type fields: list
+        :param batch_size: The number of rows passed to the database at once
+        :type batch_size: Integer
+        :param commit: If `True` (default), the rows are committed after the
+            last chunk has been updated.
+        :type commit: Boolean
+        :return: The number of updated rows
+        :rtype: Integer
+        """
+        pk = cls._pk
+        if not pk:
+            raise AttributeError("Updating a model needs an existing PK!")
+        __query__ = Query(Query.QTYPE_UPDATE, cls._fields,
+                        table=cls._name,
+                        pk=pk,
+                        fields=fields)
+        ret = __query__.run()
+        if not ret:
+            return 0
+        statement, values = ret
+        names = values.keys()
+        positions = [(name, cls._field_index[name]) for name in names]
+        if fields is not None:
+            names = fields
+
+        def row(instance):
+            values = instance._values
+            return dict((name, values[i]) for name, i in positions)
+
+        instances = (instance for instance in iterable
+            if instance[pk] and instance.is_dirty(names))
+        count = 0
+        while True:
+            batch = list(islice(instances, batch_size))
+            if not batch:
+                break
+            db.executemany(statement, [row(instance) for instance in batch],
+                model=cls)
+            count += len(batch)
+            for instance in batch:
+                if instance._dirty is None or fields is None:
+                    instance._dirty = set()
+                else:
+                    instance._dirty.difference_update(fields)
+        if commit:
+            db.commit()
+        return count
+
+    @classmethod
+    def get_or_create(cls, defaults=None, commit=True, **kwargs):
+        """
+        Inserts a new object unless an object violating a unique index
+        already exists, and returns the new or the existing object::
+
+            >>> Player.get_or_create(nickname='alice',
+            ...     defaults={'firstname': 'Alice'})
+            (<player pk=1>, True)
+
+        The object is inserted first (``INSERT OR IGNORE``), so there is no
+        race between looking up and creating the object. If a row was
+        inserted, no further query is needed. Otherwise, the existing object
+        is queried by `kwargs`. Hence, `kwargs` should contain the fields of
+        a unique index (see :py:class:`pychallenge.db.fields.Index`).
+
+        Databases of older versions may lack the unique index (see
+        :py:func:`create_indexes`). Then, the object is looked up first and
+        only inserted if it does not exist.
+
+        :param defaults: Additional field values for a new object
+        :type defaults: dictionary
+        :param commit: If `True` (default), the new object is committed
+        :type commit: Boolean
+        :param kwargs: The field values identifying the object
+        :return: Tuple (the object, `True` if it was created)
+        :rtype: tuple
+        """
+        unique = cls._has_unique_index(kwargs)
+        if not unique:
+            existing = cls.query().get(**kwargs)
+            if existing is not None:
+                return existing, False
+
+        values = dict(defaults or {})
+        values.update(kwargs)
+        instance = cls(**values)
+        __query__ = Query(Query.QTYPE_INSERT, cls._fields,
+                        table=cls._name,
+                        pk=cls._pk,
+                        ignore_conflicts=unique,
+                        values=instance._as_dict())
+        ret = __query__.run()
+        if not ret:
+            return None, False
+        statement, values = ret
+        cursor = db.execute(statement, values, model=cls)
+        if commit:
+            db.commit()
+        if cursor.rowcount == 1:
+            if cls._pk:
+                instance[cls._pk] = cursor.lastrowid
+            instance._dirty = set()
+            return instance, True
+        return cls.query().get(**kwargs), False
+
+    @classmethod
+    def _has_unique_index(cls, names):
+        """
+        The result is cached for the current database, so the schema is only
+        looked up once. :py:func:`create_indexes` and :py:func:`drop` clear
+        the cache.
+
+        :param names: the names of fields
+        :return: `True` if a unique index on some of the fields `names`
+            exists in the database
+        :rtype: Boolean
+        """
+        key = (db._generation, frozenset(names))
+        found = cls._unique_indexes.get(key, None)
+        if found is None:
+            found = False
+            for name, index in cls._indexes.items():
+                if index.unique and set(index.fields) <= set(names) and \
+                        db.index_exists(name):
+                    found = True
+                    break
+            cls._unique_indexes[key] = found
+        return found
 
     @classmethod
     def create(cls, dry_run=False):
         """
-        This method creates the table in the database.
+        This method creates the table and its indexes in the database.
 
         :param dry_run: `True` or `False`. If dry_run is `True`, the
             database query is not executed.
         :type dry_run: boolean
         """
-        fields = {}
-        for f, t in cls.__dict__.items():
-            if isinstance(t, Field):
-                fields[f] = t
-
         kwargs = {
-            'table': cls.__name__.lower(),
+            'table': cls._name,
             'dry_run': dry_run,
         }
-        cls.__query__ = Query(Query.QTYPE_CREATE, fields, **kwargs)
-        ret = cls.__query__.run()
+        __query__ = Query(Query.QTYPE_CREATE, cls._fields, **kwargs)
+        ret = __query__.run()
         if ret:
             statement, values = ret
-            db.execute(statement, values)
+            db.execute(statement, values, model=cls)
+        cls.create_indexes(dry_run)
+
+    @classmethod
+    def table_exists(cls):
+        """
+        :return: `True` if the table of the model exists in the database
+        :rtype: Boolean
+        """
+        return db.table_exists(cls._name)
+
+    @classmethod
+    def create_indexes(cls, dry_run=False):
+        """
+        This method creates all indexes declared for this model that do not
+        exist yet. Thus, it can be used to add new indexes to an existing
+        database.
+
+        :param dry_run: `True` or `False`. If dry_run is `True`, the
+            database query is not executed.
+        :type dry_run: boolean
+        """
+        for name, index in sorted(cls._indexes.items()):
+            __query__ = Query(Query.QTYPE_INDEX, cls._fields,
+                            table=cls._name,
+                            dry_run=dry_run,
+                            index=(name, index))
+            ret = __query__.run()
+            if ret:
+                statement, values = ret
+                db.execute(statement, values, model=cls)
+        cls._unique_indexes.clear()
 
     @classmethod
     def commit(self):
@@ -152,39 +518,56 @@ class Model(object):
         This function forces a commit of all data within the current
         connection
         """
-        connection.commit()
+        db.commit()
 
     def save(self, commit=True):
         """
         Calling the save methode will store the object in the databse.
 
+        If the object already exists in the database, only the modified
+        fields are written. If no field was modified since the object was
+        loaded or saved, nothing is written at all.
+
         :param commit: If `True` (default), each change will direct affect the
             database. If `commit` is `False`
         :type commit: Boolean
         """
-        if self.pk and self.__meta__['fields'][self.pk].value:
-            __query__ = Query(Query.QTYPE_UPDATE, self.__meta__['fields'],
-                            table=self.__meta__['name'],
-                            pk=self.pk)
+        if self._pk and self[self._pk]:
+            if not self.is_dirty():
+                return
+            fields = None
+            if self._dirty is not None:
+                fields = self._dirty - set([self._pk])
+                if not fields:
+                    self._dirty = set()
+                    return
+            __query__ = Query(Query.QTYPE_UPDATE, self._fields,
+                            table=self._name,
+                            pk=self._pk,
+                            fields=fields,
+                            values=self._as_dict())
             ret = __query__.run()
             if ret:
                 statement, values = ret
-                db.execute(statement, values)
+                db.execute(statement, values, model=self.__class__)
+                self._dirty = set()
                 if commit:
-                    connection.commit()
+                    db.commit()
 
         else:
-            __query__ = Query(Query.QTYPE_INSERT, self.__meta__['fields'],
-                            table=self.__meta__['name'],
-                            pk=self.pk)
+            __query__ = Query(Query.QTYPE_INSERT, self._fields,
+                            table=self._name,
+                            pk=self._pk,
+                            values=self._as_dict())
             ret = __query__.run()
             if ret:
                 statement, values = ret
-                db.execute(statement, values)
+                cursor = db.execute(statement, values, model=self.__class__)
                 if commit:
-                    connection.commit()
-                if self.pk:
-                    self.__meta__['fields'][self.pk].value = db.lastrowid
+                    db.commit()
+                if self._pk:
+                    self[self._pk] = cursor.lastrowid
+                self._dirty = set()
 
     def delete(self, commit=True):
         """
@@ -194,16 +577,17 @@ class Model(object):
         :param commit: If true, each change will direct affect the database
         :type commit: Boolean
         """
-        if self.pk and self.__meta__['fields'][self.pk].value:
-            __query__ = Query(Query.QTYPE_DELETE, self.__meta__['fields'],
-                            table=self.__meta__['name'],
-                            pk=self.pk)
+        if self._pk and self[self._pk]:
+            __query__ = Query(Query.QTYPE_DELETE, self._fields,
+                            table=self._name,
+                            pk=self._pk,
+                            values=self._as_dict())
             ret = __query__.run()
             if ret:
                 statement, values = ret
-                db.execute(statement, values)
+                db.execute(statement, values, model=self.__class__)
                 if commit:
-                    connection.commit()
+                    db.commit()
 
     @classmethod
     def drop(cls):
@@ -211,12 +595,13 @@ class Model(object):
         This method drops this table from the database.
         """
         # TODO: dry_run
-        __query__ = Query(Query.QTYPE_DROP, {}, table=cls.__name__.lower())
+        cls._unique_indexes.clear()
+        __query__ = Query(Query.QTYPE_DROP, {}, table=cls._name)
         ret = __query__.run()
         if ret:
             statement, values = ret
-            db.execute(statement, values)
-            connection.commit()
+            db.execute(statement, values, model=cls)
+            db.commit()
 
     @classmethod
     def truncate(cls):
@@ -224,106 +609,468 @@ class Model(object):
         This method removes all records in this table from the database.
         """
         # TODO: dry_run
-        __query__ = Query(Query.QTYPE_TRUNCATE, {}, table=cls.__name__.lower())
+        __query__ = Query(Query.QTYPE_TRUNCATE, {}, table=cls._name)
         ret = __query__.run()
         if ret:
             statement, values = ret
-            db.execute(statement, values)
-            connection.commit()
+            db.execute(statement, values, model=cls)
+            db.commit()
 
     @classmethod
-    def get(cls, **kwargs):
+    def query(cls, dry_run=False):
+        """
+        This function initializes and constructs the prepared database query
+        statement and is used to run functions like
+        :py:func:`QuerySet.all` or :py:func:`QuerySet.get`.
+
+        :param dry_run: `True` or `False`. If dry_run is `True`, the
+            database query is not executed.
+        :type dry_run: boolean
+        :return: a new query set for this model
+        :rtype: :py:class:`QuerySet`
+        """
+        return QuerySet(cls, dry_run)
+
+    @classmethod
+    def get_many(cls, field, values):
+        """
+        Queries all objects whose `field` has one of the given `values` with
+        as few queries as possible::
+
+            >>> Player.get_many('nickname', ['alice', 'bob'])
+            {u'alice': <player pk=1>, u'bob': <player pk=2>}
+
+        The values are passed with ``IN (...)`` queries in chunks of at most
+        :py:attr:`pychallenge.db.query.Query.MAX_VARIABLES` values.
+
+        :param field: The name of the field to look up
+        :type field: String
+        :param values: The values of `field` to look up
+        :type values: iterable
+        :return: A dictionary value --> instance. Values without a matching
+            object are missing. If several objects match a value, the first
+            one is returned.
+        :rtype: dictionary
+        """
+        if field not in cls._fields:
+            raise AttributeError("Unknown field %s" % field)
+        values = list(set(values))
+        result = {}
+        for start in xrange(0, len(values), Query.MAX_VARIABLES):
+            chunk = values[start:start + Query.MAX_VARIABLES]
+            # Pad the chunk to a power of two by repeating a value, so only
+            # a few different statements are rendered and cached.
+            size = 1
+            while size < len(chunk):
+                size *= 2
+            chunk += chunk[-1:] * (min(size, Query.MAX_VARIABLES) -
+                len(chunk))
+            for instance in cls.query().iterator(**{field + '__in': chunk}):
+                result.setdefault(instance[field], instance)
+        return result
+
+    def __repr__(self):
+        """
+        :return: Returns a readable and unambiguous representation of a modal\
+        instance
+        """
+        if self._pk:
+            return "<%s pk=%s>" % (self._name, self[self._pk])
+        else:
+            return "<%s instance>" % self._name
+
+
+def _columns(cursor):
+    """
+    :param cursor: A cursor with an executed select statement
+    :type cursor: :py:class:`sqlite3.Cursor`
+    :return: the column names of `cursor`
+    :rtype: tuple
+    """
+    return tuple(d[0] for d in cursor.description)
+
+
+class QuerySet(object):
+    """
+    A query set is returned by :py:func:`Model.query` and builds a select
+    statement for its model. The query is stored in the query set itself and
+    not in the model class, so each thread can build its own queries::
+
+        >>> Player.query().filter(player_id__lt=4).all()
+        [<player pk=1>, <player pk=2>, <player pk=3>]
+    """
+
+    def __init__(self, model, dry_run=False):
+        """
+        :param model: the model class to query
+        :type model: subclass of :py:class:`Model`
+        :param dry_run: `True` or `False`. If dry_run is `True`, the
+            database query is not executed.
+        :type dry_run: boolean
+        """
+        self.model = model
+        self.query = Query(Query.QTYPE_SELECT, model._fields,
+                        table=model._name,
+                        dry_run=dry_run)
+        # (foreign key name, referenced model) of the joined models
+        self.related = []
+
+    def __iter__(self):
+        """
+        :return: iterates over the objects (see :py:func:`iterator`)
+        """
+        return self.iterator()
+
+    def all(self, **kwargs):
+        """
+        This function returns all objects that match all performed
+        (:py:func:`filter`) queries. If there are no results,
+        :py:func:`all` returns an empty list.
+
+        :param kwargs: Any type of filter query (see :py:func:`filter`)
+        :return: A list of instances or an empty list if there are no matching
+        :rtype: list
+        """
+        self.query.filter(**kwargs)
+
+        ret = self.query.run()
+        if ret:
+            columns, rows = self._fetch(ret[0], ret[1])
+            convert = self._row_factory(columns)
+            return [convert(row) for row in rows]
+        return []
+
+    def iterator(self, chunk_size=1000, **kwargs):
+        """
+        This function does the same as :py:func:`all`, but instead of
+        building a list of all objects, it returns an iterator that fetches
+        the rows in chunks of `chunk_size` rows from the database and creates
+        the instances on the fly. Thus, the memory usage does not depend on
+        the number of rows.
+
+        The query is executed with its own cursor, so other queries can be
+        run while iterating.
+
+        :param chunk_size: The number of rows fetched from the database at
+            once
+        :type chunk_size: Integer
+        :param kwargs: Any type of filter query (see :py:func:`filter`)
+        :return: An iterator over all instances matching the query
+        :rtype: iterator
+        """
+        self.query.filter(**kwargs)
+
+        ret = self.query.run()
+        if ret:
+            statement, values = ret
+            cursor = self.model._cursor()
+            cursor.execute(statement, values)
+            return self._iter_cursor(cursor, chunk_size)
+        return iter([])
+
+    #: :py:func:`stream` is an alias for :py:func:`iterator`
+    stream = iterator
+
+    def _iter_cursor(self, cursor, chunk_size):
+        """
+        :param cursor: A cursor with an executed select statement
+        :type cursor: :py:class:`sqlite3.Cursor`
+        :param chunk_size: The number of rows fetched at once
+        :type chunk_size: Integer
+        :return: A generator yielding an instance per row of `cursor`
+        """
+        convert = self._row_factory(_columns(cursor))
+        for row in self._iter_rows(cursor, chunk_size):
+            yield convert(row)
+
+    def get(self, **kwargs):
         """
         :return: returns a single instances of the model or None if there is
             no object matching the pattern.
         :rtype: either an instance of the current model class or None
         """
-        cls.__query__ = cls.__query__.filter(**kwargs).limit(1)
+        self.query.filter(**kwargs).limit(1)
 
-        ret = cls.__query__.run()
+        ret = self.query.run()
         if ret:
-            statement, values = ret
-            db.execute(statement, values)
-            for row in db:
-                instance = cls(**row)
-                return instance
+            columns, rows = self._fetch(ret[0], ret[1])
+            if rows:
+                return self._row_factory(columns)(rows[0])
         return None
 
-    @classmethod
-    def query(cls, dry_run=False):
+    def _fetch(self, statement, values):
         """
-        This function initializes and constructs the prepared database query
-        statement and is used to run functions like :py:func:`all`,
-        :py:func:`save`, :py:func:`delete`, :py:func:`create`
+        Executes the select `statement` and fetches all rows. If the query
+        result cache is enabled (see :py:func:`pychallenge.db.get_cache`),
+        the rows are taken from and stored in the cache. The cached rows are
+        tuples, so each call creates new instances from them.
 
-        :param dry_run: `True` or `False`. If dry_run is `True`, the
-            database query is not executed.
-        :type dry_run: boolean
+        :param statement: the select statement
+        :param values: the parameters of the statement
+        :type statement: String
+        :type values: dictionary
+        :return: the column names and the rows
+        :rtype: tuple
         """
-        fields = {}
-        for f, t in cls.__dict__.items():
-            if isinstance(t, Field):
-                fields[f] = t
+        tables = [self.model._name] + [ref_model._name
+            for name, ref_model in self.related]
+        cache = db.get_cache(tables)
+        if cache is not None:
+            key = cache.key(statement, values)
+            result = cache.get(key)
+            if result is not None:
+                return result
+            version = cache.version(tables)
+        cursor = self.model._cursor()
+        cursor.execute(statement, values)
+        result = (_columns(cursor), tuple(cursor.fetchall()))
+        cursor.close()
+        if cache is not None:
+            cache.put(key, tables, version, result)
+        return result
 
-        kwargs = {
-            'table': cls.__name__.lower(),
-            'dry_run': dry_run,
-        }
-        cls.__query__ = Query(Query.QTYPE_SELECT, fields, **kwargs)
-        return cls
+    def _execute_values(self, fields):
+        """
+        Executes the query for the given fields.
 
-    @classmethod
-    def filter(cls, **kwargs):
+        :param fields: The field names; all fields if empty
+        :type fields: tuple
+        :return: A cursor returning plain tuples, or None for a dry run
+        """
+        if self.related:
+            raise AttributeError("Values cannot be combined with "
+                "select_related")
+        self.query.select(*(fields or self.model._field_names))
+        ret = self.query.run()
+        if not ret:
+            return None
+        statement, values = ret
+        cursor = self.model._cursor()
+        cursor.execute(statement, values)
+        return cursor
+
+    def values(self, *fields):
+        """
+        Returns the rows as dictionaries field name --> value instead of
+        model instances::
+
+            >>> Player.query().filter(player_id=1).values('nickname')
+            [{'nickname': u'alice'}]
+
+        :param fields: The field names; all fields if omitted
+        :type fields: String
+        :return: A list of dictionaries
+        :rtype: list
+        """
+        fields = fields or self.model._field_names
+        cursor = self._execute_values(fields)
+        if cursor is None:
+            return []
+        result = [dict(zip(fields, row)) for row in cursor]
+        cursor.close()
+        return result
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Returns the rows as plain tuples, in the order of `fields`. Neither
+        dictionaries nor model instances are created, so this is the fastest
+        way to read many rows::
+
+            >>> Match1on1.query().values_list('player1', 'outcome')
+            [(1, 0.5), (2, 1), ...]
+            >>> Match1on1.query().values_list('date', flat=True)
+            [1, 1, 2, ...]
+
+        :param fields: The field names; all fields if omitted
+        :type fields: String
+        :param flat: If `True`, returns the single values instead of 1-tuples.
+            Only allowed for a single field.
+        :type flat: Boolean
+        :param iterator: If `True`, returns an iterator that fetches the rows
+            in chunks of `chunk_size` rows (see :py:func:`iterator`)
+        :type iterator: Boolean
+        :param chunk_size: The number of rows fetched at once by the iterator
+        :type chunk_size: Integer
+        :return: A list (or iterator) of tuples or values
+        """
+        flat = kwargs.pop('flat', False)
+        iterator = kwargs.pop('iterator', False)
+        chunk_size = kwargs.pop('chunk_size', 1000)
+        if kwargs:
+            raise AttributeError("Unknown arguments %s" % ", ".join(kwargs))
+        if flat and len(fields) != 1:
+            raise AttributeError("flat is only allowed for a single field")
+        cursor = self._execute_values(fields)
+        if cursor is None:
+            return iter([]) if iterator else []
+        if iterator:
+            rows = self._iter_rows(cursor, chunk_size)
+            if flat:
+                return (row[0] for row in rows)
+            return rows
+        result = cursor.fetchall()
+        cursor.close()
+        if flat:
+            return [row[0] for row in result]
+        return result
+
+    def columns(self, *fields):
+        """
+        Returns the values column-wise, e.g. as input for vectorized
+        computations::
+
+            >>> player1, player2 = Match1on1.query().columns('player1',
+            ...     'player2')
+
+        :param fields: The field names; all fields if omitted
+        :type fields: String
+        :return: A tuple with a list of values for each field
+        :rtype: tuple
+        """
+        fields = fields or self.model._field_names
+        rows = self.values_list(*fields)
+        if not rows:
+            return tuple([] for f in fields)
+        return tuple(list(column) for column in zip(*rows))
+
+    def _iter_rows(self, cursor, chunk_size):
+        """
+        :param cursor: A cursor with an executed select statement
+        :type cursor: :py:class:`sqlite3.Cursor`
+        :param chunk_size: The number of rows fetched at once
+        :type chunk_size: Integer
+        :return: A generator yielding the rows of `cursor`
+        """
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def _row_factory(self, columns):
+        """
+        :param columns: The column names of the rows
+        :type columns: tuple
+        :return: a function that converts a row into an instance and stores
+            the joined objects in its cache (see :py:func:`select_related`)
+        """
+        if not self.related:
+            return self.model._row_factory(columns)
+        model = self.model
+        slices = []
+        start = len(model._field_names)
+        for name, ref_model in self.related:
+            end = start + len(ref_model._field_names)
+            slices.append((name, model._field_index[name], ref_model,
+                ref_model._field_index[ref_model._pk], start, end))
+            start = end
+
+        def convert(row):
+            instance = model._from_values(row[:len(model._field_names)])
+            related = {}
+            for name, index, ref_model, pk_index, start, end in slices:
+                values = row[start:end]
+                if values[pk_index] is None:
+                    ref = None
+                else:
+                    ref = ref_model._from_values(values)
+                related[name] = (instance._values[index], ref)
+            instance._related = related
+            return instance
+        return convert
+
+    def select_related(self, *fields):
+        """
+        Fetches the objects referenced by the given foreign keys with the
+        same query, using a `LEFT JOIN`. Accessing ``instance.fk.related``
+        then does not query the database::
+
+            >>> for rank in Rank_Elo.query().select_related('player_id'):
+            ...     print rank.player_id.related.nickname.value
+
+        Only foreign keys referencing the primary key of a model are
+        supported.
+
+        :param fields: The names of :py:class:`pychallenge.db.fields.FK`
+            fields
+        :type fields: String
+        """
+        for name in fields:
+            field = self.model._fields.get(name, None)
+            if not isinstance(field, FK):
+                raise AttributeError("%s is not a foreign key" % name)
+            ref_model = field.ref_model
+            if field.ref_field != ref_model._pk:
+                raise AttributeError("%s does not reference a primary key" %
+                    name)
+            self.query.join(name, ref_model._name, field.ref_field,
+                ref_model._field_names)
+            self.related.append((name, ref_model))
+        return self
+
+    def filter(self, **kwargs):
         """
         Filter the fields of any select statement to the given fields. See
-        :py:func:`pychallenge.db.db.Query.filter` for a description of
+        :py:func:`pychallenge.db.query.Query.filter` for a description of
         kwargs and return the prepared / filtered query.
 
         If no :py:func:`join_or` is invoked, all filter statements are
         connected by `AND`.
 
         *Confer*: :py:func:`filter_or`, :py:func:`join_and`,
-        :py:func:`join_or`, :py:func:`pychallenge.db.db.Query.filter`
+        :py:func:`join_or`, :py:func:`pychallenge.db.query.Query.filter`
         """
-        cls.__query__ = cls.__query__.filter(**kwargs)
-        return cls
+        self.query.filter(**kwargs)
+        return self
 
-    @classmethod
-    def filter_or(cls, **kwargs):
+    def filter_or(self, **kwargs):
         """
         This function does the same :py:func:`filter`, but connects the
         statements by `OR`.
 
         *Confer*: :py:func:`filter`, :py:func:`join_and`,
-        :py:func:`join_or`, :py:func:`pychallenge.db.db.Query.filter`
+        :py:func:`join_or`, :py:func:`pychallenge.db.query.Query.filter`
         """
-        cls.__query__ = cls.__query__.filter_or(**kwargs)
-        return cls
+        self.query.filter_or(**kwargs)
+        return self
 
-    @classmethod
-    def join_and(cls):
+    def join_and(self):
         """
         This forces a connection of the given filter statements by `AND`.
 
         *Confer*: :py:func:`filter`, :py:func:`filter_or`,
-        :py:func:`join_or`, :py:func:`pychallenge.db.db.Query.filter`
+        :py:func:`join_or`, :py:func:`pychallenge.db.query.Query.filter`
         """
-        cls.__query__ = cls.__query__.join_and()
-        return cls
+        self.query.join_and()
+        return self
 
-    @classmethod
-    def join_or(cls):
+    def join_or(self):
         """
         This forces a connection of the given filter statements by `OR`.
 
         *Confer*: :py:func:`filter`, :py:func:`filter_or`,
-        :py:func:`join_and`, :py:func:`pychallenge.db.db.Query.filter`
+        :py:func:`join_and`, :py:func:`pychallenge.db.query.Query.filter`
         """
-        cls.__query__ = cls.__query__.join_or()
-        return cls
+        self.query.join_or()
+        return self
 
-    @classmethod
-    def limit(cls, count, offset=None):
+    def order_by(self, *fields):
+        """
+        Sorts the result by the given fields or expressions. A leading `-`
+        sorts in descending order::
+
+            >>> Rank_Glicko.query().order_by('-rating - rd', 'id').limit(10)
+
+        *Confer*: :py:func:`pychallenge.db.query.Query.order_by`
+        """
+        self.query.order_by(*fields)
+        return self
+
+    def limit(self, count, offset=None):
         """
         The limit functions returns only the first (by database) `count`
         rows of the the database.
@@ -334,72 +1081,120 @@ class Model(object):
             `offset` objects.
         :type offset: positiv Integer
         """
-        cls.__query__ = cls.__query__.limit(count, offset)
-        return cls
+        self.query.limit(count, offset)
+        return self
 
-    def _set_meta_field(self, name, **kwargs):
+    def update(self, **kwargs):
         """
-        :param name: This is the name of a field
-        :param value: The value that will be assigned to the field
-        :param instance: This attribute is used for adding a new field to the
-            model
-        :type name: String
-        :type value: variable
-        :type instance: :py:class:`pychallenge.db.fields.Field`
+        Sets the given fields of all rows matching the filters with a single
+        UPDATE statement::
+
+            >>> Rank_Elo.query().filter(value__lt=1000).update(value=1000)
+
+        Model instances that were loaded before are not changed.
+
+        :param kwargs: field name --> new value
+        :return: The number of updated rows
+        :rtype: Integer
         """
-        value = instance = None
-        try:
-            instance = kwargs.pop('instance')
-        except KeyError:
-            try:
-                value = kwargs.pop('value')
-            except KeyError:
-                raise AssertionError
-
-        if not (instance or name in self.__meta__['fields']):
-            raise AttributeError('Field "%s" does not exists in model "%s"' %
-                (name, self.__meta__['name']))
-        if instance:
-            self.__meta__['fields'][name] = instance
-        else:
-            self.__meta__['fields'][name].value = value
+        fields = self.model._fields
+        values = dict((name, (fields[name].clean(value)
+            if name in fields and value is not None else value))
+            for name, value in kwargs.iteritems())
+        __query__ = Query(Query.QTYPE_UPDATE_WHERE, fields,
+                        table=self.model._name,
+                        dry_run=self.query.dry_run,
+                        values=values,
+                        where=self.query)
+        return self._execute_write(__query__)
 
-    def _get_meta_field(self, name):
+    def delete(self):
         """
-        :param name: The name of the referred field
-        :type name: String
-        :return: either the value of field :py:attr:`name` or
-            :py:attr:`default` if not defined
+        Deletes all rows matching the filters with a single DELETE
+        statement::
+
+            >>> Match1on1.query().filter(date__lt=10).delete()
+
+        :return: The number of deleted rows
+        :rtype: Integer
         """
-        if not name in self.__meta__['fields']:
-            raise AttributeError("The field %s does not exists in model %s" %
-                (name, self.__meta__['name']))
-        return self.__meta__['fields'].get(name)
+        __query__ = Query(Query.QTYPE_DELETE_WHERE, self.model._fields,
+                        table=self.model._name,
+                        dry_run=self.query.dry_run,
+                        where=self.query)
+        return self._execute_write(__query__)
 
-    def __setattr__(self, name, value):
+    def _execute_write(self, query):
         """
-        Overloaded :py:func:`__setter__` function to set field values
+        Executes and commits an UPDATE or DELETE query.
 
-        :param name: The name of the referred field
-        :param value: The value that will be stored
-        :type name: String
-        :type String: variable
+        :param query: The query to execute
+        :type query: :py:class:`pychallenge.db.query.Query`
+        :return: The number of changed rows
+        :rtype: Integer
         """
-        if self.__dict__:
-            try:
-                self._set_meta_field(name, value=value)
-            except AttributeError:
-                self.__dict__[name] = value
-        else:
-            super(Model, self).__setattr__(name, value)
+        ret = query.run()
+        if not ret:
+            return 0
+        statement, values = ret
+        count = db.execute(statement, values, model=self.model).rowcount
+        db.commit()
+        return count
 
-    def __repr__(self):
+    def after(self, values):
         """
-        :return: Returns a readable and unambiguous representation of a modal\
-        instance
+        Keyset pagination: returns only the rows after the row with the
+        given values of the ordered fields. Pass the values of the last row
+        of the previous page::
+
+            >>> page = Match1on1.query().order_by('date', 'match_id') \\
+            ...     .limit(50).all()
+            >>> last = page[-1]
+            >>> Match1on1.query().order_by('date', 'match_id') \\
+            ...     .after((last.date.value, last.match_id.value)) \\
+            ...     .limit(50).all()
+
+        *Confer*: :py:func:`pychallenge.db.query.Query.after`
         """
-        if self.pk:
-            return "<%s pk=%s>" % (self.__meta__['name'],
-                self.__meta__['fields'][self.pk].value)
-        else:
-            return "<%s instance>" % self.__meta__['name']
+        self.query.after(values)
+        return self
+
+    def count(self):
+        """
+        :return: The number of matching rows, counted by the database
+        :rtype: Integer
+        """
+        ret = self.query.count().run()
+        if not ret:
+            return 0
+        statement, values = ret
+        cursor = self.model._cursor()
+        count = cursor.execute(statement, values).fetchone()[0]
+        cursor.close()
+        return count
+
+    def exists(self):
+        """
+        :return: `True` if there is at least one matching row
+        :rtype: Boolean
+        """
+        ret = self.query.exists().run()
+        if not ret:
+            return False
+        statement, values = ret
+        cursor = self.model._cursor()
+        exists = cursor.execute(statement, values).fetchone() is not None
+        cursor.close()
+        return exists
+
+    def truncate(self):
+        """
+        Removes all records of the model, see :py:func:`Model.truncate`.
+        """
+        self.model.truncate()
+
+    def drop(self):
+        """
+        Drops the table of the model, see :py:func:`Model.drop`.
+        """
+        self.model.drop()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import sys
+import threading
+from time import time
+
+
+"""
+The :py:mod:`pychallenge.db.profiler` module measures the statements executed
+by :py:mod:`pychallenge.db`. Profiling is started with
+:py:func:`pychallenge.db.start_profiling`; while it is active, all cursors
+are :py:class:`ProfilingCursor` objects that report to the active
+:py:class:`Profiler`.
+"""
+
+
+class StatementStats(object):
+    """
+    The collected measurements of a single statement.
+    """
+    __slots__ = ('statement', 'calls', 'time', 'rows', 'parameters',
+        'models')
+
+    def __init__(self, statement):
+        """
+        :param statement: the SQL statement
+        :type statement: String
+        """
+        self.statement = statement
+        #: number of executions
+        self.calls = 0
+        #: total wall time of the executions and fetches in seconds
+        self.time = 0.0
+        #: number of returned (SELECT) or changed rows
+        self.rows = 0
+        #: number of bound parameters of the last execution
+        self.parameters = 0
+        #: the names of the models that executed the statement
+        self.models = set()
+
+    def __repr__(self):
+        """
+        :return: This returns a string formatted stats-object
+        """
+        return '<%s %d calls %.3fs "%s">' % (self.__class__.__name__,
+            self.calls, self.time, self.statement)
+
+
+class Profiler(object):
+    """
+    Collects the statistics of all executed statements, see
+    :py:func:`pychallenge.db.start_profiling`::
+
+        >>> profiler = db.start_profiling(slow_query_time=0.5)
+        >>> Player.query().all()
+        >>> db.stop_profiling()
+        >>> print profiler.summary()
+    """
+
+    def __init__(self, slow_query_time=None, out=None):
+        """
+        :param slow_query_time: Statements that take at least this number of
+            seconds are logged together with their query plan
+        :type slow_query_time: Float
+        :param out: The stream for the slow query log, defaults to stderr
+        :type out: file
+        """
+        self.slow_query_time = slow_query_time
+        self.out = out or sys.stderr
+        #: statement --> :py:class:`StatementStats`
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, statement, parameters, seconds, rows, model=None):
+        """
+        Records an execution of `statement`.
+
+        :param statement: the SQL statement
+        :param parameters: the number of bound parameters
+        :param seconds: the wall time of the execution
+        :param rows: the number of changed rows
+        :param model: the model that executed the statement
+        :type statement: String
+        :type parameters: Integer
+        :type seconds: Float
+        :type rows: Integer
+        :type model: :py:class:`pychallenge.db.models.Model`
+        """
+        with self.lock:
+            stats = self.statements.get(statement, None)
+            if stats is None:
+                stats = self.statements[statement] = StatementStats(statement)
+            stats.calls += 1
+            stats.time += seconds
+            stats.rows += max(rows, 0)
+            stats.parameters = parameters
+            if model is not None:
+                stats.models.add(model.__name__)
+
+    def add_fetch(self, statement, seconds, rows):
+        """
+        Adds the time and the number of rows of a fetch to `statement`.
+        """
+        with self.lock:
+            stats = self.statements.get(statement, None)
+            if stats is not None:
+                stats.time += seconds
+                stats.rows += rows
+
+    def check_slow(self, cursor, statement, parameters, seconds):
+        """
+        Logs `statement` and its query plan if it took at least
+        ``slow_query_time`` seconds.
+
+        :param cursor: the cursor that executed the statement
+        :type cursor: :py:class:`sqlite3.Cursor`
+        """
+        if self.slow_query_time is None or seconds < self.slow_query_time:
+            return
+        lines = ["Slow query (%.3fs): %s" % (seconds, statement)]
+        try:
+            plan = cursor.connection.execute("EXPLAIN QUERY PLAN " +
+                statement, parameters).fetchall()
+            for row in plan:
+                row = row.values() if isinstance(row, dict) else row
+                lines.append("\t%s" % row[-1])
+        except sqlite3.Error, e:
+            lines.append("\tNo query plan: %s" % e)
+        with self.lock:
+            self.out.write("\n".join(lines) + "\n")
+
+    def top(self, key, limit=10):
+        """
+        :param key: the attribute of :py:class:`StatementStats` to sort by,
+            e.g. ``'time'`` or ``'calls'``
+        :param limit: the number of returned statements
+        :return: The statistics of the statements with the highest `key`
+        :rtype: list
+        """
+        with self.lock:
+            stats = self.statements.values()
+        return sorted(stats, key=lambda s: getattr(s, key),
+            reverse=True)[:limit]
+
+    def summary(self, limit=10):
+        """
+        :param limit: the number of statements in each table
+        :return: A summary of the top statements by total time and by number
+            of calls
+        :rtype: String
+        """
+        lines = []
+        with self.lock:
+            stats = self.statements.values()
+        lines.append("%d statements, %d executions, %.3fs" % (len(stats),
+            sum(s.calls for s in stats), sum(s.time for s in stats)))
+        for title, key in (("total time", 'time'), ("calls", 'calls')):
+            lines.append("")
+            lines.append("Top statements by %s:" % title)
+            lines.append("%9s %7s %9s %6s  %s" % ("time", "calls", "rows",
+                "params", "statement"))
+            for s in self.top(key, limit):
+                lines.append("%8.3fs %7d %9d %6d  %s%s" % (s.time, s.calls,
+                    s.rows, s.parameters, s.statement,
+                    (" [%s]" % ", ".join(sorted(s.models)))
+                    if s.models else ""))
+        return "\n".join(lines)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    A cursor that reports each execution and fetch to a
+    :py:class:`Profiler`. The fetch times and the number of fetched rows are
+    added to the executed statement. The slow query check runs when all rows
+    were fetched or the cursor executes the next statement.
+    """
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Cursor.__init__(self, *args, **kwargs)
+        #: the profiler, set by :py:func:`pychallenge.db.new_cursor`
+        self.profiler = None
+        #: the model that uses the cursor
+        self.model = None
+        self._current = None
+
+    def _finish(self):
+        """
+        Runs the slow query check for the current statement.
+        """
+        if self._current is not None:
+            statement, parameters, seconds = self._current
+            self._current = None
+            self.profiler.check_slow(self, statement, parameters, seconds)
+
+    def _fetched(self, seconds, rows, done):
+        """
+        Adds a fetch to the current statement.
+        """
+        if self._current is not None:
+            self._current[2] += seconds
+            self.profiler.add_fetch(self._current[0], seconds, rows)
+            if done:
+                self._finish()
+
+    def execute(self, statement, parameters=()):
+        self._finish()
+        start = time()
+        cursor = sqlite3.Cursor.execute(self, statement, parameters)
+        seconds = time() - start
+        self.profiler.record(statement, len(parameters), seconds,
+            self.rowcount, self.model)
+        self._current = [statement, parameters, seconds]
+        return cursor
+
+    def executemany(self, statement, seq_of_parameters):
+        self._finish()
+        seq_of_parameters = list(seq_of_parameters)
+        start = time()
+        cursor = sqlite3.Cursor.executemany(self, statement,
+            seq_of_parameters)
+        seconds = time() - start
+        self.profiler.record(statement,
+            sum(len(p) for p in seq_of_parameters), seconds, self.rowcount,
+            self.model)
+        if seq_of_parameters:
+            self._current = [statement, seq_of_parameters[0], seconds]
+        return cursor
+
+    def fetchone(self):
+        start = time()
+        row = sqlite3.Cursor.fetchone(self)
+        self._fetched(time() - start, int(row is not None), row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time()
+        if size is None:
+            rows = sqlite3.Cursor.fetchmany(self)
+        else:
+            rows = sqlite3.Cursor.fetchmany(self, size)
+        self._fetched(time() - start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = time()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._fetched(time() - start, len(rows), True)
+        return rows
+
+    def next(self):
+        start = time()
+        try:
+            row = sqlite3.Cursor.next(self)
+        except StopIteration:
+            self._fetched(time() - start, 0, True)
+            raise
+        self._fetched(time() - start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        sqlite3.Cursor.close(self)
@@ -1,26 +1,70 @@
 # -*- coding: utf-8 -*-
+import re
 from pychallenge.conf import settings
 from pychallenge.db import fields
 
+#: A token of an arithmetic expression: a number, a name, an operator or a
+#: parenthesis
+EXPRESSION_TOKEN = re.compile(r'\s*(\d+(?:\.\d*)?|[A-Za-z_]\w*|[-+*/()])')
+
+
+def expression(text, fieldnames, table=None):
+    """
+    Validates an arithmetic expression over the fields of a model, e.g.
+    ``rating - 2 * rd``. Expressions may only contain field names, numbers,
+    the operators ``+ - * /`` and parentheses, so they can safely be
+    inserted into a statement.
+
+    :param text: the expression
+    :type text: String
+    :param fieldnames: the names of the model fields
+    :type fieldnames: list
+    :param table: if given, the field names are qualified by this table name
+    :type table: String
+    :return: the normalized expression
+    :rtype: String
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = EXPRESSION_TOKEN.match(text, position)
+        if m is None:
+            raise AttributeError("Invalid expression %s" % text)
+        token = m.group(1)
+        if token[0].isalpha() or token[0] == '_':
+            if token not in fieldnames:
+                raise AttributeError("Unknown field %s" % token)
+            if table:
+                token = "%s.%s" % (table, token)
+        tokens.append(token)
+        position = m.end()
+    if not tokens:
+        raise AttributeError("Empty expression")
+    return " ".join(tokens).replace("( ", "(").replace(" )", ")")
+
 
 class KeyTable():
 
     def __init__(self):
         self.keys = {}
+        # the parameter names in the order they were added
+        self.names = []
 
     def __repr__(self):
         return str(self.keys)
 
     def used(self, name):
-        return name in self.keys.keys()
+        return name in self.keys
 
     def add(self, name, value=None):
         n = name
         i = 1
-        while n in self.keys.keys():
+        while n in self.keys:
             n = "%s_%d" % (name, i)
             i = i + 1
         self.keys[n] = value
+        self.names.append(n)
         return n
 
     def get(self):
@@ -45,6 +89,12 @@ class KeyTable():
 class Query():
     """
     http://www.sqlite.org/lang_select.html
+
+    The rendered statements are cached by the *shape* of the query: the
+    table, the query type, the filtered fields and operators, the way the
+    filters are joined and the limit. Running a query with the same shape
+    again only binds the new parameter values to the cached statement. This
+    also lets sqlite3 reuse its prepared statements.
     """
 
     QTYPE_SELECT = 1
@@ -54,9 +104,22 @@ class Query():
     QTYPE_CREATE = 5
     QTYPE_TRUNCATE = 6
     QTYPE_DROP = 7
+    QTYPE_INDEX = 8
+    QTYPE_UPDATE_WHERE = 9
+    QTYPE_DELETE_WHERE = 10
 
     AGGREGATE = ['avg', 'count', 'min', 'max']
 
+    #: The maximum number of cached statements
+    STATEMENT_CACHE_SIZE = 500
+
+    #: The maximum number of parameters of a statement. This is the default
+    #: SQLITE_MAX_VARIABLE_NUMBER of SQLite versions before 3.32.0.
+    MAX_VARIABLES = 999
+
+    #: query shape --> (statement, parameter names)
+    _statements = {}
+
     def __init__(self, qtype, modelfields, **kwargs):
         """
 
@@ -65,21 +128,44 @@ class Query():
         self.qtype = qtype
         self.modelfield_names = modelfields.keys()
         self.modelfields = modelfields
+        # field name --> value of the row to insert, update or delete
+        self.values = kwargs.pop('values', {})
         self.key_table = KeyTable()
         self.dry_run = kwargs.get('dry_run', False)
         self.filter_fields = []
         self.select_fields = []
+        # the selected field names in the requested order; all fields (in
+        # sorted order) if empty
+        self.select_names = ()
+        # selects COUNT(*) or 1 instead of fields, see count() and exists()
+        self.select_raw = None
+        # the values of the ordered fields of the last row of the previous
+        # page, see after()
+        self.after_values = ()
         self.limit_expression = ""
+        # tuples (expression, descending) of the ORDER BY clause
+        self.order_fields = []
+        # tuples (fk field, ref table, ref field, ref field names) of the
+        # tables joined by LEFT JOIN
+        self.joins = []
+        # the filter operations in the order they were applied; either
+        # (connector, field names, list sizes) or (join, None, None). The
+        # list sizes are the lengths of the `__in` and `__nin` lists, or
+        # None for other filters.
+        self.filter_ops = []
+        # the filter values in the order of the field names in filter_ops;
+        # the lists of `__in` and `__nin` are flattened
+        self.filter_values = []
 
         if not kwargs.get('table', None):
             raise AttributeError("Missing table definition")
         self.table = kwargs.pop('table')
 
         if self.qtype == Query.QTYPE_SELECT:
-            self._select(**kwargs)
+            pass
 
         elif self.qtype == Query.QTYPE_INSERT:
-            pass
+            self._insert(**kwargs)
 
         elif self.qtype == Query.QTYPE_UPDATE:
             self._update(**kwargs)
@@ -96,14 +182,89 @@ class Query():
         elif self.qtype == Query.QTYPE_DROP:
             pass
 
+        elif self.qtype == Query.QTYPE_INDEX:
+            self._index(**kwargs)
+
+        elif self.qtype in (Query.QTYPE_UPDATE_WHERE,
+                Query.QTYPE_DELETE_WHERE):
+            self._where(**kwargs)
+
         else:
             raise AttributeError("qtype must be one of QTYPE_SELECT, "
                 "QTYPE_INSERT, QTYPE_UPDATE, QTYPE_DELETE, "
-                "QTYPE_CREATE", "QTYPE_TRUNCATE", "QTYPE_DROP")
+                "QTYPE_CREATE", "QTYPE_TRUNCATE", "QTYPE_DROP", "QTYPE_INDEX",
+                "QTYPE_UPDATE_WHERE", "QTYPE_DELETE_WHERE")
 
     def run(self):
         """
         Call this method to build the actual query.
+
+        :return: None for a dry run, else a tuple of the statement and a
+            dictionary with the parameters
+        """
+        shape = self._shape()
+        cached = Query._statements.get(shape, None)
+        if cached is None:
+            cached = self._render()
+            if shape is not None:
+                if len(Query._statements) >= Query.STATEMENT_CACHE_SIZE:
+                    Query._statements.clear()
+                Query._statements[shape] = cached
+        statement, names = cached
+
+        if self.qtype == Query.QTYPE_SELECT:
+            parameters = dict(zip(names, self.filter_values +
+                list(self.after_values)))
+        elif self.qtype == Query.QTYPE_DELETE_WHERE:
+            parameters = dict(zip(names, self.filter_values))
+        elif self.qtype == Query.QTYPE_UPDATE_WHERE:
+            parameters = dict(zip(names, [self.values[n]
+                for n in sorted(self.values)] + self.filter_values))
+        else:
+            parameters = dict((n, self.values.get(n, None)) for n in names)
+
+        if self.dry_run:
+            print statement
+            if settings.SETTINGS['DEBUG']:
+                if parameters:
+                    print parameters
+            return None
+        elif settings.SETTINGS['DEBUG']:
+            print statement
+            if parameters:
+                print parameters
+        return (statement, parameters)
+
+    def _shape(self):
+        """
+        :return: The cache key of this query, or None if the statement must
+            not be cached
+        """
+        if self.qtype == Query.QTYPE_SELECT:
+            return (self.table, self.qtype, self.select_names,
+                self.select_raw, tuple(self.filter_ops), tuple(self.joins),
+                tuple(self.order_fields), bool(self.after_values),
+                self.limit_expression)
+        elif self.qtype == Query.QTYPE_INSERT:
+            return (self.table, self.qtype, self.with_pk,
+                self.ignore_conflicts)
+        elif self.qtype == Query.QTYPE_UPDATE:
+            return (self.table, self.qtype, self.pk, self.update_fields)
+        elif self.qtype == Query.QTYPE_DELETE:
+            return (self.table, self.qtype, self.pk)
+        elif self.qtype == Query.QTYPE_UPDATE_WHERE:
+            return (self.table, self.qtype, tuple(sorted(self.values)),
+                tuple(self.filter_ops))
+        elif self.qtype == Query.QTYPE_DELETE_WHERE:
+            return (self.table, self.qtype, tuple(self.filter_ops))
+        return None
+
+    def _render(self):
+        """
+        Renders the statement of this query.
+
+        :return: Tuple of the statement and the parameter names in the order
+            of the values
         """
 
         def match(x):
@@ -129,55 +290,94 @@ class Query():
             return "%s = :%s" % (x, x)
 
         if self.qtype == Query.QTYPE_SELECT:
+            self._select()
             statement = "SELECT %(_fields)s FROM %(_table)s"
             replace = {
                 '_fields': ", ".join(self.select_fields),
                 '_table': self.table,
             }
+            self._render_filters()
+            table = self.table if self.joins else None
+            if self.after_values:
+                # keyset pagination: compare the row values of the ordered
+                # fields with the last row of the previous page
+                after = "((%s) %s (%s))" % (
+                    ", ".join(expression(e, self.modelfield_names, table)
+                        for e, desc in self.order_fields),
+                    "<" if self.order_fields[0][1] else ">",
+                    ", ".join(":%s" % self.key_table.add(name="after")
+                        for v in self.after_values))
+                self.filter_fields.append(after)
+                self._join(" AND ")
+            if not self.select_raw:
+                for i, (fk, ref_table, ref_field, ref_names) in \
+                        enumerate(self.joins):
+                    statement += " LEFT JOIN %s AS _j%d ON _j%d.%s = %s" % (
+                        ref_table, i, i, ref_field, self._column(fk))
             if self.filter_fields:
-                self.join_and()
                 statement += " WHERE %(_filter)s"
                 replace['_filter'] = self.filter_fields[0]
 
+            if self.order_fields:
+                statement += " ORDER BY " + ", ".join(
+                    expression(e, self.modelfield_names, table) +
+                    (" DESC" if desc else "")
+                    for e, desc in self.order_fields)
             statement += self.limit_expression
+            if self.select_raw == "COUNT(*)" and self.limit_expression:
+                # count the rows within the limit
+                statement = "SELECT COUNT(*) FROM (%s)" % statement
+                replace['_fields'] = "1"
 
         elif self.qtype == Query.QTYPE_INSERT:
-            statement = "INSERT INTO %(_table)s (%(_fs)s) VALUES (%(_vs)s)"
-            ff = {}
-            for k, f in self.modelfields.iteritems():
-                if isinstance(f, fields.PK):
+            statement = "INSERT %(_or)sINTO %(_table)s (%(_fs)s) " \
+                "VALUES (%(_vs)s)"
+            ff = []
+            for k in sorted(self.modelfield_names):
+                f = self.modelfields[k]
+                if isinstance(f, fields.PK) and not self.with_pk:
                     continue
-                ff[k] = ":%s" % k
-                self.key_table.add(name=k, value=f.value)
+                ff.append(k)
+                self.key_table.add(name=k)
 
             replace = {
+                '_or': "OR IGNORE " if self.ignore_conflicts else "",
                 '_table': self.table,
-                '_fs': ", ".join(ff.keys()),
-                '_vs': ", ".join(ff.values())}
+                '_fs': ", ".join(ff),
+                '_vs': ", ".join(":%s" % k for k in ff)}
 
         elif self.qtype == Query.QTYPE_UPDATE:
             statement = "UPDATE %(_table)s SET %(_fields)s WHERE %(_pk)s"
-            ff = {}
-            for k, f in self.modelfields.iteritems():
-                ff["%s__eq" % k] = f.value
+            ff = filter(match, self.update_fields or
+                sorted(self.modelfield_names))
+            for k in ff:
+                self.key_table.add(name=k)
+            self.key_table.add(name=self.pk)
 
             replace = {
                 '_table': self.table,
-                '_pk': "%s = :%s__eq" % (self.pk, self.pk),
-                '_fields': ", ".join(self._get_filter_fields(**ff))}
+                '_pk': format(self.pk),
+                '_fields': ", ".join(map(format, ff))}
 
         elif self.qtype == Query.QTYPE_DELETE:
             statement = "DELETE FROM %(_table)s WHERE %(_pk)s"
             replace = {
                 '_table': self.table,
                 '_pk': "%s = :%s" % (self.pk, self.pk)}
-            self.key_table.add(self.pk, self.modelfields[self.pk].value)
+            self.key_table.add(self.pk)
 
         elif self.qtype == Query.QTYPE_CREATE:
             statement = "CREATE TABLE `%(_table)s` (%(_fields)s);"
             flds = []
             for f, i in self.modelfields.iteritems():
-                if isinstance(i, fields.Numeric):
+                if isinstance(i, fields.Integer):
+                    flds.append("`%s` INTEGER" % f)
+                elif isinstance(i, fields.Real):
+                    flds.append("`%s` REAL" % f)
+                elif isinstance(i, fields.SmallEnum):
+                    flds.append("`%s` %s" % (f,
+                        "INTEGER" if i.integer else "REAL"))
+                elif isinstance(i, fields.Numeric):
                     flds.append("`%s` NUMERIC" % f)
                 elif isinstance(i, fields.Text):
                     flds.append("`%s` TEXT" % f)
@@ -196,17 +396,40 @@ class Query():
             statement = "DROP TABLE %(_table)s"
             replace = {'_table': self.table}
 
-        if self.dry_run:
-            print statement % replace
-            if settings.SETTINGS['DEBUG']:
-                if self.key_table:
-                    print self.key_table
-            return None
-        elif settings.SETTINGS['DEBUG']:
-            print statement % replace
-            if self.key_table:
-                print self.key_table
-        return (statement % replace, self.key_table.get())
+        elif self.qtype == Query.QTYPE_UPDATE_WHERE:
+            statement = "UPDATE %(_table)s SET %(_fields)s"
+            ff = sorted(self.values)
+            for k in ff:
+                self.key_table.add(name=k)
+            replace = {
+                '_table': self.table,
+                '_fields': ", ".join(map(format, ff))}
+            self._render_filters()
+            if self.filter_fields:
+                statement += " WHERE %(_filter)s"
+                replace['_filter'] = self.filter_fields[0]
+
+        elif self.qtype == Query.QTYPE_DELETE_WHERE:
+            statement = "DELETE FROM %(_table)s"
+            replace = {'_table': self.table}
+            self._render_filters()
+            if self.filter_fields:
+                statement += " WHERE %(_filter)s"
+                replace['_filter'] = self.filter_fields[0]
+
+        elif self.qtype == Query.QTYPE_INDEX:
+            statement = "CREATE %(_unique)sINDEX IF NOT EXISTS `%(_name)s` " \
+                "ON `%(_table)s` (%(_fields)s);"
+            replace = {
+                '_unique': "UNIQUE " if self.index.unique else "",
+                '_name': self.index_name,
+                '_table': self.table,
+                '_fields': ", ".join(("`%s`" % f) if f in self.modelfields
+                    else expression(f, self.modelfield_names)
+                    for f in self.index.fields),
+            }
+
+        return (statement % replace, self.key_table.names)
 
     def filter(self, **kwargs):
         """
@@ -219,60 +442,275 @@ class Query():
             Use `__in` and `__nin` and assign either a `list` or a `tuple` for
             `IN` or `NOT IN`.
         """
-        ff = self._get_filter_fields(**kwargs)
-        if ff:
-            tmp = "(" + " AND ".join(ff) + ")"
-            self.filter_fields.append(tmp)
-        return self
+        return self._add_filter('AND', kwargs)
 
     def filter_or(self, **kwargs):
         """
         See :py:func:`pychallenge.db.db.Query.filter`.
         The only difference is the combination `OR`.
         """
-        ff = self._get_filter_fields(**kwargs)
-        if ff:
-            tmp = "(" + " OR ".join(ff) + ")"
-            self.filter_fields.append(tmp)
-        return self
+        return self._add_filter('OR', kwargs)
 
     def join_and(self):
         """
         use this function to concat filter expressions with *AND*
         """
-        if len(self.filter_fields) > 1:
-            tmp = "(" + " AND ".join(self.filter_fields) + ")"
-            self.filter_fields = [tmp]
+        self.filter_ops.append(('JOIN_AND', None, None))
         return self
 
     def join_or(self):
         """
         use this function to concat filter expressions with *OR*
         """
-        if len(self.filter_fields) > 1:
-            tmp = "(" + " OR ".join(self.filter_fields) + ")"
-            self.filter_fields = [tmp]
+        self.filter_ops.append(('JOIN_OR', None, None))
+        return self
+
+    def select(self, *fields):
+        """
+        Restricts the selected columns to the given fields, in the given
+        order. Without fields, all fields are selected.
+
+        :param fields: the field names
+        :type fields: String
+        """
+        self.select_names = tuple(self._get_select_fields(fields))
         return self
 
+    def order_by(self, *fields):
+        """
+        Sorts the result by the given fields. Prepend `-` to a field name to
+        sort in descending order. Instead of a field name, an arithmetic
+        expression of the fields can be given, e.g. ``-rating - rd`` sorts
+        descending by ``rating - rd`` (see :py:func:`expression`).
+
+        :param fields: the field names or expressions
+        :type fields: String
+        """
+        order = []
+        for f in fields:
+            desc = f.startswith('-')
+            if desc:
+                f = f[1:]
+            order.append((expression(f, self.modelfield_names), desc))
+        self.order_fields = order
+        return self
+
+    def join(self, fk, ref_table, ref_field, ref_names):
+        """
+        Adds the columns of the row of `ref_table` referenced by the foreign
+        key `fk` to the result, using a `LEFT JOIN`. The columns of the
+        joined table follow the columns of the queried table; the columns of
+        each joined table are in the order of `ref_names`.
+
+        :param fk: the name of the foreign key field
+        :param ref_table: the referenced table
+        :param ref_field: the referenced field
+        :param ref_names: the field names of the referenced table
+        :type fk: String
+        :type ref_table: String
+        :type ref_field: String
+        :type ref_names: list
+        """
+        if not fk in self.modelfield_names:
+            raise AttributeError("Unknown field %s" % fk)
+        self.joins.append((fk, ref_table, ref_field, tuple(ref_names)))
+        return self
+
+    def _column(self, name):
+        """
+        :param name: a field name of the queried table
+        :type name: String
+        :return: the column name, qualified by the table name if other
+            tables are joined
+        """
+        if self.joins:
+            return "%s.%s" % (self.table, name)
+        return name
+
     def limit(self, count, offset=None):
+        """
+        Returns at most `count` rows, skipping the first `offset` rows. Large
+        offsets are slow, since the skipped rows are computed anyway; use
+        :py:func:`after` to page through large results.
+
+        :param count: the maximum number of rows
+        :param offset: the number of skipped rows
+        :type count: Integer
+        :type offset: Integer
+        """
         if offset:
-            self.limit_expression = " LIMIT %d, %d" % (count, offset)
+            self.limit_expression = " LIMIT %d OFFSET %d" % (count, offset)
         else:
             self.limit_expression = " LIMIT %d" % count
         return self
 
+    def after(self, values):
+        """
+        Keyset pagination: only returns the rows after the row with the
+        given values of the ordered fields (see :py:func:`order_by`), e.g.
+        the last row of the previous page. In contrast to an offset, the
+        skipped rows are not computed if there is an index for the order::
+
+            >>> q.order_by('date', 'match_id').after((date, match_id))
+
+        All fields must be sorted in the same direction.
+
+        :param values: the values of the ordered fields
+        :type values: tuple
+        """
+        if len(values) != len(self.order_fields) or not values:
+            raise AttributeError("after needs a value for each field of "
+                "order_by")
+        if len(set(desc for e, desc in self.order_fields)) != 1:
+            raise AttributeError("after needs all fields sorted in the same "
+                "direction")
+        self.after_values = tuple(values)
+        return self
+
+    def count(self):
+        """
+        Selects the number of matching rows instead of the rows.
+        """
+        self.select_raw = "COUNT(*)"
+        return self
+
+    def exists(self):
+        """
+        Selects 1 if there is a matching row.
+        """
+        self.select_raw = "1"
+        return self.limit(1)
+
+    def _add_filter(self, connector, kwargs):
+        """
+        Records a filter operation. The filter expression itself is only
+        rendered if there is no cached statement for the query shape.
+
+        :param connector: Either `AND` or `OR`
+        :param kwargs: the filter arguments (see :py:func:`filter`)
+        """
+        if kwargs:
+            names = tuple(sorted(kwargs.keys()))
+            sizes = []
+            for n in names:
+                v = kwargs[n]
+                if n.endswith('__in') or n.endswith('__nin'):
+                    if not isinstance(v, (tuple, list)):
+                        raise AttributeError("%s needs a list or a tuple" %
+                            n)
+                    sizes.append(len(v))
+                    self.filter_values.extend(v)
+                else:
+                    sizes.append(None)
+                    self.filter_values.append(v)
+            self.filter_ops.append((connector, names, tuple(sizes)))
+        return self
+
+    def _render_filters(self):
+        """
+        Replays the recorded filter operations and joins the rendered filter
+        expressions into ``filter_fields[0]``.
+        """
+        values = iter(self.filter_values)
+
+        def take(size):
+            if size is None:
+                return values.next()
+            return [values.next() for i in range(size)]
+
+        for connector, names, sizes in self.filter_ops:
+            if connector == 'AND':
+                self._filter(" AND ", dict((n, take(size))
+                    for n, size in zip(names, sizes)))
+            elif connector == 'OR':
+                self._filter(" OR ", dict((n, take(size))
+                    for n, size in zip(names, sizes)))
+            elif connector == 'JOIN_AND':
+                self._join(" AND ")
+            else:
+                self._join(" OR ")
+        if self.filter_fields:
+            self._join(" AND ")
+
+    def _filter(self, connector, kwargs):
+        """
+        Renders a filter expression and adds it to the filter fields.
+        """
+        ff = self._get_filter_fields(**kwargs)
+        if ff:
+            tmp = "(" + connector.join(ff) + ")"
+            self.filter_fields.append(tmp)
+
+    def _join(self, connector):
+        """
+        Concats the rendered filter expressions.
+        """
+        if len(self.filter_fields) > 1:
+            tmp = "(" + connector.join(self.filter_fields) + ")"
+            self.filter_fields = [tmp]
+
     def _select(self, **kwargs):
         """
 
         """
-        self.select_fields += self._get_select_fields(self.modelfield_names,
-             aggregate=True)
-        # unique `self.select_fields`
-        tmp = {}
-        for e in self.select_fields:
-            tmp[e] = 1
-        self.select_fields = tmp.keys()
-        self.select_fields.sort()
+        if self.select_raw:
+            self.select_fields = [self.select_raw]
+            return
+        elif self.select_names:
+            # a projection keeps the requested order
+            self.select_fields = list(self.select_names)
+        else:
+            self.select_fields += self._get_select_fields(
+                self.modelfield_names, aggregate=True)
+            # unique `self.select_fields`
+            tmp = {}
+            for e in self.select_fields:
+                tmp[e] = 1
+            self.select_fields = tmp.keys()
+            self.select_fields.sort()
+        if self.joins:
+            self.select_fields = map(self._column, self.select_fields)
+            for i, join in enumerate(self.joins):
+                self.select_fields += ["_j%d.%s" % (i, f) for f in join[3]]
+
+    def _insert(self, **kwargs):
+        """
+
+        """
+        self.pk = kwargs.pop('pk', None)
+        # insert the primary key column as well, e.g. for bulk inserts with
+        # precomputed primary keys
+        self.with_pk = kwargs.pop('with_pk', False)
+        # skip rows that violate a unique constraint instead of failing
+        self.ignore_conflicts = kwargs.pop('ignore_conflicts', False)
+
+    def _index(self, **kwargs):
+        """
+
+        """
+        if 'index' in kwargs.keys():
+            self.index_name, self.index = kwargs.pop('index')
+        else:
+            raise AttributeError("Missing index definition")
+
+    def _where(self, **kwargs):
+        """
+        Takes the filters of the select query `where` for an UPDATE or
+        DELETE of all matching rows.
+        """
+        where = kwargs.pop('where', None)
+        if where is not None:
+            if where.joins or where.order_fields or where.limit_expression:
+                raise AttributeError("Only filters are supported when "
+                    "updating or deleting rows of a query")
+            self.filter_ops = list(where.filter_ops)
+            self.filter_values = list(where.filter_values)
+        if self.qtype == Query.QTYPE_UPDATE_WHERE:
+            if not self.values:
+                raise AttributeError("Nothing to update")
+            for f in self.values:
+                if not f in self.modelfield_names:
+                    raise AttributeError("Unknown field %s" % f)
 
     def _update(self, **kwargs):
         """
@@ -282,6 +720,16 @@ class Query():
             self.pk = kwargs.pop('pk')
         else:
             raise AttributeError("Updating a model needs an existing PK!")
+        # only these fields are set, all fields if None
+        update_fields = kwargs.pop('fields', None)
+        if update_fields is not None:
+            update_fields = tuple(sorted(update_fields))
+            for f in update_fields:
+                if not f in self.modelfield_names:
+                    raise AttributeError("Unknown field %s" % f)
+            if not filter(lambda f: f != self.pk, update_fields):
+                raise AttributeError("Nothing to update")
+        self.update_fields = update_fields
 
     def _delete(self, **kwargs):
         """
@@ -297,8 +745,8 @@ class Query():
         def build(f, id, op):
             return '%s %s :%s' % (f, op, id)
 
-        def lbuild(f, id, op):
-            return '%s %s (:%s)' % (f, op, id)
+        def lbuild(f, ids, op):
+            return '%s %s (%s)' % (f, op, ", ".join(":%s" % i for i in ids))
 
         op = {
             'lt': '<',
@@ -312,8 +760,9 @@ class Query():
             'in': 'IN',
             'nin': 'NOT IN'}
         flds = []
-        # iterate over all given filter fields
-        for f, v in kwargs.iteritems():
+        # iterate over all given filter fields; sorted, since the parameter
+        # names must be the same for each query of the same shape
+        for f, v in sorted(kwargs.iteritems()):
 
             # split the filter comparison
             parts = f.split('__')
@@ -321,7 +770,7 @@ class Query():
             # if no comparison is specified act as __eq
             if len(parts) == 1 and parts[0] in self.modelfield_names:
                 n = self.key_table.add(name=f, value=v)
-                flds.append(build(parts[0], n, op['eq']))
+                flds.append(build(self._column(parts[0]), n, op['eq']))
 
             # there is a concrete comparison
             elif len(parts) == 2 and parts[0] in self.modelfield_names:
@@ -329,13 +778,15 @@ class Query():
                 # it's a simple comparision operator
                 if parts[1] in op.keys():
                     n = self.key_table.add(name=f, value=v)
-                    flds.append(build(parts[0], n, op[parts[1]]))
+                    flds.append(build(self._column(parts[0]), n,
+                        op[parts[1]]))
 
                 # comparision on lists
+                # each list element is bound to its own parameter
                 elif parts[1] in lop.keys():
-                    assert isinstance(v, (tuple, list))
-                    n = self.key_table.add(name=f, value=v)
-                    flds.append(lbuild(parts[0], n, lop[parts[1]]))
+                    ns = [self.key_table.add(name=f, value=e) for e in v]
+                    flds.append(lbuild(self._column(parts[0]), ns,
+                        lop[parts[1]]))
 
                 # this comparision operator is unknown
                 else:
@@ -351,9 +802,9 @@ class Query():
         """
 
         """
+        flds = []
         # if we accept aggregation functions MIN, MAX, AVG, COUNT ...
         if aggregate:
-            flds = []
 
             # iterate over the list of all given fields
             for f in fields:
@@ -6,21 +6,29 @@ class Config(models.Model):
     key = models.Text()
     value = models.Text()
 
+    key_idx = models.Index('key', unique=True)
+
 
 class Algorithm(models.Model):
     algorithm_id = models.PK()
     name = models.Text()
     description = models.Text()
-    algorithm_type_id = models.Numeric()  # FK('Algorithm_Type')
+    algorithm_type_id = models.Integer()  # FK('Algorithm_Type')
 
 
 class Match1on1(models.Model):
     match_id = models.PK()
-    game_id = models.Numeric()  # FK('.....')
+    game_id = models.Integer()  # FK('.....')
     player1 = models.FK('Player', 'player_id')
     player2 = models.FK('Player', 'player_id')
-    date = models.Numeric()
-    outcome = models.Numeric()
+    # the number of the rating period, e.g. the month
+    date = models.Integer()
+    # 0: player1 lost, 0.5: draw, 1: player1 won
+    outcome = models.SmallEnum((0, 0.5, 1))
+
+    player1_date_idx = models.Index('player1', 'date')
+    player2_date_idx = models.Index('player2', 'date')
+    date_idx = models.Index('date')
 
 
 class Player(models.Model):
@@ -29,18 +37,43 @@ class Player(models.Model):
     lastname = models.Text()
     nickname = models.Text()
 
+    nickname_idx = models.Index('nickname', unique=True)
+
 
 class Rank_Elo(models.Model):
     id = models.PK()
     player_id = models.FK('Player', 'player_id')
-    game_id = models.Numeric()  # FK('Game')
-    value = models.Numeric(value=1500)
+    game_id = models.Integer()  # FK('Game')
+    # the elo ratings are rounded to whole numbers
+    value = models.Integer(value=1500)
+
+    player_game_idx = models.Index('player_id', 'game_id')
+    value_idx = models.Index('value')
 
 
 class Rank_Glicko(models.Model):
     id = models.PK()
     player_id = models.FK('Player', 'player_id')
-    game_id = models.Numeric()  # FK('Game')
-    rd = models.Numeric(value=350)
-    rating = models.Numeric(value=1500)
-    last_match = models.Numeric(value=1)
+    game_id = models.Integer()  # FK('Game')
+    rd = models.Real(value=350)
+    rating = models.Real(value=1500)
+    last_match = models.Integer(value=1)
+
+    player_game_idx = models.Index('player_id', 'game_id')
+    # the conservative rating estimate used by the leaderboards
+    score_idx = models.Index('rating - rd')
+
+
+class Rank_Glicko2(models.Model):
+    id = models.PK()
+    player_id = models.FK('Player', 'player_id')
+    game_id = models.Integer()  # FK('Game')
+    # rating and rd are stored on the Glicko scale
+    rd = models.Real(value=350)
+    rating = models.Real(value=1500)
+    # the rating volatility
+    sigma = models.Real(value=0.06)
+    last_match = models.Integer(value=1)
+
+    player_game_idx = models.Index('player_id', 'game_id')
+    score_idx = models.Index('rating - rd')
@@ -2,12 +2,164 @@
 import sys
 import argparse
 import pychallenge
-from pychallenge.algorithms import elo, glicko
-from pychallenge.models import Match1on1, Player, Rank_Elo, Rank_Glicko, Config
+from pychallenge import db
+from pychallenge.algorithms import elo, glicko, glicko2, scheduler
+from pychallenge.conf import settings
+from pychallenge.db import bulk_pragmas, transaction
+from pychallenge.models import Match1on1, Player, Rank_Elo, Rank_Glicko, \
+    Rank_Glicko2, Config
 from pychallenge.ui import utils
+import copy_reg
 import csv
 import os
 import math
+import multiprocessing
+import sqlite3
+from array import array
+from itertools import islice
+
+#: Number of rows collected before they are stored with a bulk insert
+BULK_SIZE = 10000
+
+#: Number of matches packed into arrays and replayed at once by update_elo
+ELO_CHUNK_SIZE = 1000000
+
+#: The valid outcomes of a match
+OUTCOMES = Match1on1._fields['outcome'].choices
+
+
+def unpack_array(typecode, data):
+    """
+    Rebuilds an array pickled by :py:func:`pack_array`.
+    """
+    values = array(typecode)
+    values.fromstring(data)
+    return values
+
+
+def pack_array(values):
+    """
+    Pickles an array as its binary data instead of a list of its items. This
+    keeps the packed matches sent to the processes of :py:func:`run_jobs`
+    small.
+    """
+    return unpack_array, (values.typecode, values.tostring())
+
+copy_reg.pickle(array, pack_array)
+
+
+def rated_matches():
+    """
+    :return: the query set of the matches with a valid outcome. Older
+        versions imported invalid outcomes, which are skipped by the rating
+        updates.
+    :rtype: :py:class:`pychallenge.db.models.QuerySet`
+    """
+    return Match1on1.query().filter(outcome__in=OUTCOMES)
+
+
+def run_job(job):
+    """
+    Runs a job of :py:func:`run_jobs`.
+
+    :param job: a function and its arguments
+    :type job: tuple
+    """
+    function, arguments = job
+    return function(*arguments)
+
+
+def run_jobs(jobs, processes):
+    """
+    Runs the jobs in a pool of `processes` processes. The functions and their
+    arguments must be picklable.
+
+    :param jobs: a list of tuples (function, arguments)
+    :param processes: the maximum number of processes
+    :type jobs: list
+    :type processes: Integer
+    :return: the results of the jobs, in the order of `jobs`
+    :rtype: list
+    """
+    if processes <= 1 or len(jobs) <= 1:
+        return [run_job(job) for job in jobs]
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        return pool.map(run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_processes(args):
+    """
+    :param args: A list with arguments from the argument parser
+    :type args: namespace
+    :return: the number of processes for the update, see the setting
+        ``PROCESSES``
+    :rtype: Integer
+    """
+    processes = args.processes
+    if processes is None:
+        processes = settings.SETTINGS['PROCESSES']
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    return max(processes, 1)
+
+
+def split_shards(index, processes, order, columns):
+    """
+    Splits the matches into at most `processes` shards of players that never
+    met the players of the other shards, see
+    :py:func:`pychallenge.algorithms.scheduler.shards`. The matches are read
+    twice: first the players of all matches to find the shards, then the
+    matches of the shards. Only the shards are kept in memory, packed into
+    arrays.
+
+    :param index: player_id --> position of the rank of the player
+    :param processes: the maximum number of shards
+    :param order: the fields the matches of each shard are ordered by
+    :param columns: the fields of the matches besides the players, with the
+        type codes of their arrays, e.g. ``[('outcome', 'd')]``
+    :type index: dictionary
+    :type processes: Integer
+    :type order: list
+    :type columns: list of tuples
+    :return: None if the matches form at most one shard. Otherwise, the
+        arrays (players, player1List, player2List, columns...) of each shard.
+        The players of the matches are given by their position in the
+        players of the shard.
+    :rtype: list of lists
+    """
+    pairs = rated_matches().values_list('player1', 'player2', iterator=True,
+        chunk_size=BULK_SIZE)
+    shardOf, shardCount = scheduler.shards(((index[player1], index[player2])
+        for player1, player2 in pairs), len(index), processes)
+    if shardCount <= 1:
+        return None
+
+    shards = [[array('l'), array('l'), array('l')] +
+        [array(code) for name, code in columns] for shard in range(shardCount)]
+    # the position of each player in the players of its shard
+    local = array('l', [0]) * len(index)
+    for player, shard in enumerate(shardOf):
+        if shard >= 0:
+            players = shards[shard][0]
+            local[player] = len(players)
+            players.append(player)
+    for row in rated_matches().order_by(*order).values_list('player1',
+            'player2', *[name for name, code in columns], iterator=True,
+            chunk_size=BULK_SIZE):
+        player1 = index[row[0]]
+        shard = shards[shardOf[player1]]
+        shard[1].append(local[player1])
+        shard[2].append(local[index[row[1]]])
+        for i in range(2, len(row)):
+            shard[i + 1].append(row[i])
+    return shards
 
 
 def add_result(args):
@@ -26,15 +178,17 @@ def add_result(args):
     print "\tOutcome: ", utils.outcomes[args.outcome]
     print "\tDate: ", args.date
 
-    player1 = utils.add_player(args.player1, commit=False)
-    player2 = utils.add_player(args.player2, commit=False)
+    # the new players and the match are committed together
+    with transaction():
+        player1, created = utils.add_player(args.player1)
+        player2, created = utils.add_player(args.player2)
 
-    pid1 = player1.player_id.value
-    pid2 = player2.player_id.value
+        pid1 = player1.player_id.value
+        pid2 = player2.player_id.value
 
-    dbRow = Match1on1(player1=pid1, player2=pid2, outcome=args.outcome,
-        date=args.date)
-    dbRow.save(commit=True)
+        dbRow = Match1on1(player1=pid1, player2=pid2, outcome=args.outcome,
+            date=args.date)
+        dbRow.save()
 
     print "Done"
 
@@ -72,186 +226,301 @@ def import_results(args):
     """
     Imports the match data of a csv file into the result table.
 
+    The matches and the ranks of new players are inserted in chunks using
+    :py:func:`pychallenge.db.models.Model.bulk_create`.
+
     :param args: A list with arguments from the argument parser
     :type args: namespace
     """
 
     print "Importing results from", args.file
 
-    try:
-        csvfile, reader, hasHeader = utils.get_csv(args.file)
-        line = 0
-
-        if hasHeader:
-            print "\tFirst line of csv file is ignored. It seems to be a " \
-                  "header row.\n"
-
-        # nickname --> player
-        players = {}
-
-        for row in reader:
-            if line != 0 or (line == 0 and not hasHeader):
-                if row[1] is row[2]:
-                    continue
-
-                player1 = players.get(row[1], None)
-                player2 = players.get(row[2], None)
-                if player1 is None:
-                    player1, created = utils.add_player(row[1], commit=False)
-                    players[player1.nickname.value] = player1
-                if player2 is None:
-                    player2, created = utils.add_player(row[2], commit=False)
-                    players[player2.nickname.value] = player2
-
-                dbRow = Match1on1(player1=player1.player_id.value,
-                    player2=player2.player_id.value, outcome=row[3],
-                    date=row[0])
-                dbRow.save(commit=False)
-
-            if line % 100 == 0:
-                sys.stdout.write("\r" + "Imported %d entries..." % line)
-                sys.stdout.flush()
-            line = line + 1
-
-        Rank_Elo.commit()
-        Rank_Glicko.commit()
-        Match1on1.commit()
-        csvfile.close()
-        print "\rImported %d entries." % (line - (1 if hasHeader else 0))
-    except csv.Error:
-        print "Error importing %s in line %d" % (args.file, line)
-    except IOError:
-        print "No such file: %s" % args.file
+    with bulk_pragmas():
+        try:
+            csvfile, reader, hasHeader = utils.get_csv(args.file)
+            line = 0
+
+            if hasHeader:
+                print "\tFirst line of csv file is ignored. It seems to " \
+                      "be a header row.\n"
+
+            # nickname --> player_id of all known players
+            players = dict(Player.query().values_list('nickname',
+                'player_id'))
+            # the players created by this import; their ranks are added at
+            # the end with a bulk insert
+            new_players = []
+            matches = []
+
+            # Either the whole file is imported or nothing at all
+            with transaction():
+                for row in reader:
+                    if line != 0 or (line == 0 and not hasHeader):
+                        if row[1] == row[2]:
+                            continue
+                        if Match1on1._fields['outcome'].clean(row[3]) is None:
+                            raise ValueError("Invalid outcome %s" % row[3])
+
+                        for nickname in (row[1], row[2]):
+                            if nickname not in players:
+                                # another process may have added the player
+                                # in the meantime
+                                player, created = Player.get_or_create(
+                                    nickname=nickname, defaults={
+                                    'firstname': "", 'lastname': ""},
+                                    commit=False)
+                                players[nickname] = player.player_id.value
+                                if created:
+                                    new_players.append(player)
+
+                        matches.append(Match1on1(
+                            player1=players[row[1]], player2=players[row[2]],
+                            outcome=row[3], date=row[0]))
+                        if len(matches) >= BULK_SIZE:
+                            Match1on1.bulk_create(matches, commit=False)
+                            matches = []
+
+                    if line % 100 == 0:
+                        sys.stdout.write("\r" + "Imported %d entries..." %
+                            line)
+                        sys.stdout.flush()
+                    line = line + 1
+
+                Match1on1.bulk_create(matches, commit=False)
+                utils.add_ranks(new_players, commit=False)
+            csvfile.close()
+            print "\rImported %d entries." % (line - (1 if hasHeader else 0))
+        except csv.Error:
+            print "Error importing %s in line %d" % (args.file, line)
+        except ValueError, e:
+            print "\rError importing %s in line %d: %s. Nothing was " \
+                "imported." % (args.file, line, e)
+        except IOError:
+            print "No such file: %s" % args.file
 
 
 def update(args):
     def update_elo():
-        sys.stdout.write("Query matches...")
-        matches = Match1on1.query().all()
-        sys.stdout.write("\rBeginning to update %d matches" % len(matches))
-        print ""
-
         # constants
         conf = utils.get_config(args)
         k = conf["elo.chess.k"]
         func = conf["elo.chess.function"]
+        scale = conf["elo.chess.scale"]
 
-        # Query all ratings and store it in a dictionary. This is done to store
-        # the newest rating data in memory. We do not have to commit.
-        ratings = Rank_Elo.query().all()
-        rdict = {}
-        for r in ratings:
-            rdict[r.player_id.value] = r
-
-        updates = 0
-        for match in matches:
-            rating1 = rdict[match.player1.value]
-            rating2 = rdict[match.player2.value]
-
-            result = elo.elo1on1(rating1.value.value, rating2.value.value,
-                match.outcome.value, k, func)
-            rating1.value = result[0]
-            rating2.value = result[1]
-
-            updates = updates + 1
-            if updates % 50 == 0:
-                sys.stdout.write("\r" + "Updated %d matches..." % updates)
+        # Query all ratings and keep the values in an array indexed by the
+        # position of the rank. The matches are replayed on this array.
+        ranks = Rank_Elo.query().all()
+        index = {}
+        for i, r in enumerate(ranks):
+            index[r.player_id.value] = i
+        values = [r['value'] for r in ranks]
+        ratings = array('d', values) if scale is not None else values
+
+        # Players that never met have independent ratings. The shards of
+        # such players are replayed in parallel. A custom Elo function can
+        # not be sent to other processes.
+        shards = None
+        if processes > 1 and scale is not None:
+            sys.stdout.write("Query independent players...")
+            shards = split_shards(index, processes, ['match_id'],
+                [('outcome', 'd')])
+
+        if shards is not None:
+            sys.stdout.write("\rBeginning to update the matches of %d "
+                "groups of players" % len(shards))
+            print ""
+            jobs = [(elo.rateHistory, (array('d', (values[p]
+                for p in shard[0])), shard[1], shard[2], shard[3], k, scale))
+                for shard in shards]
+            for shard, shardValues in zip(shards, run_jobs(jobs, processes)):
+                for player, value in zip(shard[0], shardValues):
+                    ratings[player] = value
+            updates = sum(len(shard[1]) for shard in shards)
+        else:
+            sys.stdout.write("\rQuery matches...")
+            total = rated_matches().count()
+            # stream the matches as plain tuples, the match table may not
+            # fit into memory
+            matches = rated_matches().order_by('match_id').values_list(
+                'player1', 'player2', 'outcome', iterator=True,
+                chunk_size=BULK_SIZE)
+            sys.stdout.write("\rBeginning to update the matches")
+            print ""
+
+            updates = 0
+            while True:
+                chunk = list(islice(matches, ELO_CHUNK_SIZE))
+                if not chunk:
+                    break
+                elo.replay(ratings,
+                    array('l', [index[row[0]] for row in chunk]),
+                    array('l', [index[row[1]] for row in chunk]),
+                    array('d', [row[2] for row in chunk]), k, func, scale)
+
+                updates = updates + len(chunk)
+                sys.stdout.write("\r" + "Updated %d of %d matches..." % (
+                    updates, total))
                 sys.stdout.flush()
 
-        # update table
-        for r in ratings:
-            r.save(commit=False)
-        Rank_Elo.commit()
+        # update table; only the ratings of players with matches changed
+        for rank, value in zip(ranks, ratings):
+            rank['value'] = value
+        Rank_Elo.bulk_update(ranks, ['value'])
         print "\rUpdated", updates, "matches."
 
-    def update_glicko():
-        sys.stdout.write("Query matches...")
-        matches = Match1on1.query().all()
-        sys.stdout.write("\rBeginning to update %d matches" % len(matches))
+    def read_periods():
+        sys.stdout.write("Query rating periods...")
+        # Only the rating periods are kept in memory. The matches of each
+        # period are queried separately.
+        periods = set(rated_matches().values_list('date', flat=True,
+            iterator=True))
+        sys.stdout.write("\rBeginning to update %d rating periods" %
+            len(periods))
+        print ""
+        return sorted(periods)
+
+    def rate_shards(ranks, fields, function, constant):
+        """
+        Rates the shards of independent players in parallel with the
+        `rateHistory` `function` of the algorithm and stores the new values
+        of `fields` in `ranks`. The last field is the date of the last
+        match. Returns False if the players form at most one shard.
+        """
+        if processes <= 1:
+            return False
+        sys.stdout.write("Query independent players...")
+        index = {}
+        for i, rank in enumerate(ranks):
+            index[rank['player_id']] = i
+        shards = split_shards(index, processes, ['date', 'match_id'],
+            [('date', 'l'), ('outcome', 'd')])
+        if shards is None:
+            sys.stdout.write("\r")
+            return False
+        sys.stdout.write("\rBeginning to update the matches of %d groups "
+            "of players" % len(shards))
         print ""
 
+        jobs = []
+        for players, player1List, player2List, dateList, outcomeList in \
+                shards:
+            arguments = [array(code, (ranks[p][field] for p in players))
+                for field, code in fields]
+            arguments += [constant, dateList, player1List, player2List,
+                outcomeList]
+            jobs.append((function, arguments))
+        for shard, values in zip(shards, run_jobs(jobs, processes)):
+            for (field, code), fieldValues in zip(fields, values):
+                for player, value in zip(shard[0], fieldValues):
+                    ranks[player][field] = value
+        print "\rDone."
+        return True
+
+    def read_period(period, rdict):
+        """
+        Returns the ranks of the players of `period` by their first match,
+        and the matches with the positions of the players.
+        """
+        players = []
+        index = {}
+        player1List = []
+        player2List = []
+        outcomeList = []
+        for player1, player2, outcome in rated_matches().filter(
+                date=period).order_by('match_id').values_list(
+                'player1', 'player2', 'outcome'):
+            for player in (player1, player2):
+                if player not in index:
+                    index[player] = len(players)
+                    players.append(rdict[player])
+            player1List.append(index[player1])
+            player2List.append(index[player2])
+            outcomeList.append(outcome)
+        return players, player1List, player2List, outcomeList
+
+    def show_progress(period):
+        stage = period % 4
+        if stage == 0:
+            sys.stdout.write("\r| ")
+        elif stage == 1:
+            sys.stdout.write("\r/ ")
+        elif stage == 2:
+            sys.stdout.write("\r--")
+        else:
+            sys.stdout.write("\r\\ ")
+        sys.stdout.flush()
+
+    def update_glicko():
         # Query all ratings and store it in a dictionary. This is done to store
         # the newest rating data in memory. We do not have to commit.
         ratings = Rank_Glicko.query().all()
+
+        # glicko.chess.c
+        if rate_shards(ratings, [('rating', 'd'), ('rd', 'd'),
+                ('last_match', 'l')], glicko.rateHistory, 15.8):
+            Rank_Glicko.bulk_update(ratings, ['last_match', 'rating', 'rd'])
+            return
+
+        periods = read_periods()
         rdict = {}
         for r in ratings:
             rdict[r.player_id.value] = r
 
-        # sort matches by date
-        matches = sorted(matches, key=lambda x: x.date.value)
-        mDict = {}
+        # for each rating period...
+        for period in periods:
+            players, player1List, player2List, outcomeList = read_period(
+                period, rdict)
+
+            # glicko.chess.c
+            ratingList, RDList = glicko.ratePeriod(
+                [rank['rating'] for rank in players],
+                [rank['rd'] for rank in players],
+                [period - rank['last_match'] for rank in players], 15.8,
+                player1List, player2List, outcomeList)
+            for rank, rating, RD in zip(players, ratingList, RDList):
+                rank['rating'] = rating
+                rank['rd'] = RD
+                rank['last_match'] = period
+
+            Rank_Glicko.bulk_update(players, ['last_match', 'rating', 'rd'])
+            show_progress(period)
+        print "\rDone."
 
-        for match in matches:
-            if match.date.value in mDict:
-                mDict[match.date.value].append(match)
-            else:
-                mDict[match.date.value] = [match]
+    def update_glicko2():
+        tau = utils.get_config(args)["glicko2.chess.tau"]
+        ratings = Rank_Glicko2.query().all()
+        if rate_shards(ratings, [('rating', 'd'), ('rd', 'd'), ('sigma', 'd'),
+                ('last_match', 'l')], glicko2.rateHistory, tau):
+            Rank_Glicko2.bulk_update(ratings,
+                ['last_match', 'rating', 'rd', 'sigma'])
+            return
 
-        # for each rating period...
-        for period, pMatches in mDict.iteritems():
-            # players in current period --> (RD, rating)
-            pDict = {}
-            for match in pMatches:
-                for player in [match.player1.value, match.player2.value]:
-                    if player not in pDict:
-                        pDict[player] = (rdict[player].rd.value,
-                            rdict[player].rating.value)
-                        # glicko.chess.c
-                        curRD = glicko.getCurrentRD(pDict[player][0], 15.8,
-                            period - rdict[player].last_match.value)
-                        curRating = rdict[player].rating.value
-                        # search all matches the player participated, in period
-                        ratingList = []
-                        RDList = []
-                        outcomeList = []
-                        for m in pMatches:
-                            # player is player1 of match
-                            if m.player1.value == player:
-                                if m.player2.value in pDict:
-                                    ratingList.append(
-                                        pDict[m.player2.value][1])
-                                    RDList.append(pDict[m.player2.value][0])
-                                else:
-                                    ratingList.append(
-                                        rdict[m.player2.value].rating.value)
-                                    RDList.append(
-                                        rdict[m.player2.value].rd.value)
-                                outcomeList.append(m.outcome.value)
-                            # player player2 of match
-                            if m.player2.value == player:
-                                if m.player1.value in pDict:
-                                    ratingList.append(
-                                        pDict[m.player1.value][1])
-                                    RDList.append(pDict[m.player1.value][0])
-                                else:
-                                    ratingList.append(
-                                        rdict[m.player1.value].rating.value)
-                                    RDList.append(
-                                        rdict[m.player1.value].rd.value)
-                                outcomeList.append(1.0 - m.outcome.value)
-
-                        # calculate new rating
-                        newRating = glicko.newRating(curRD, curRating,
-                            ratingList, RDList, outcomeList)
-                        newRD = glicko.newRD(curRD, newRating, ratingList,
-                            RDList)
-
-                        rdict[player].rd.value = newRD
-                        rdict[player].rating.value = newRating
-                        rdict[player].last_match.value = period
-                        rdict[player].save(commit=False)
-
-            Rank_Glicko.commit()
-            stage = period % 4
-            if stage == 0:
-                sys.stdout.write("\r| ")
-            elif stage == 1:
-                sys.stdout.write("\r/ ")
-            elif stage == 2:
-                sys.stdout.write("\r--")
-            else:
-                sys.stdout.write("\r\\ ")
-            sys.stdout.flush()
+        periods = read_periods()
+
+        rdict = {}
+        for r in ratings:
+            rdict[r.player_id.value] = r
+
+        for period in periods:
+            players, player1List, player2List, outcomeList = read_period(
+                period, rdict)
+
+            ratingList, RDList, sigmaList = glicko2.ratePeriod(
+                [rank['rating'] for rank in players],
+                [rank['rd'] for rank in players],
+                [rank['sigma'] for rank in players],
+                [period - rank['last_match'] for rank in players], tau,
+                player1List, player2List, outcomeList)
+            for rank, rating, RD, sigma in zip(players, ratingList, RDList,
+                    sigmaList):
+                rank['rating'] = rating
+                rank['rd'] = RD
+                rank['sigma'] = sigma
+                rank['last_match'] = period
+
+            Rank_Glicko2.bulk_update(players,
+                ['last_match', 'rating', 'rd', 'sigma'])
+            show_progress(period)
         print "\rDone."
     """
     Updates the ratings for all players.
@@ -260,11 +529,19 @@ def update(args):
     :type args: namespace
     """
 
-    update_funcs = {'elo': update_elo, 'glicko': update_glicko}
+    update_funcs = {'elo': update_elo, 'glicko': update_glicko,
+        'glicko2': update_glicko2}
+    processes = get_processes(args)
 
     print "Updating the ratings for all players in %s using %s" % (args.game,
         args.algorithm)
-    update_funcs[args.algorithm]()
+    skipped = Match1on1.query().count() - rated_matches().count()
+    if skipped:
+        print "Skipping %d matches without a valid outcome." % skipped
+    # The ratings are committed in batches, an interrupted update keeps the
+    # ratings of the already committed batches.
+    with bulk_pragmas(), transaction(commit_every=BULK_SIZE):
+        update_funcs[args.algorithm]()
 
 
 def match(args):
@@ -290,7 +567,8 @@ def match(args):
     :type args: namespace
     """
 
-    match_funcs = {'elo': match_elo, 'glicko': match_glicko}
+    match_funcs = {'elo': match_elo, 'glicko': match_glicko,
+        'glicko2': match_glicko}
 
     rating = utils.get_rating(args)
     if rating is None:
@@ -307,7 +585,7 @@ def match(args):
 
     print "Best opponent for player %s with rating %d is:" % (args.player,
         rating.value.value)
-    other = Player.query().get(player_id=opponent.player_id.value)
+    other = opponent.player_id.related
     print "\tPlayer %s with rating %d." % (other.nickname.value,
         opponent.value.value)
 
@@ -329,6 +607,11 @@ def rating(args):
         if args.algorithm == "elo":
             print "The rating for player %s in %s using %s is %d." % (
                 args.player, args.game, args.algorithm, player.value.value)
+        elif args.algorithm == "glicko2":
+            print "The rating for player %s in %s using %s is %d " \
+                "with rating deviation %d and volatility %f" % (args.player,
+                args.game, args.algorithm, player.rating.value,
+                player.rd.value, player.sigma.value)
         else:
             print "The rating for player %s in %s using %s is %d " \
                 "with rating deviation %d" % (args.player, args.game,
@@ -348,7 +631,7 @@ def predict(args):
         print "Aborted."
         return
 
-    if args.algorithm == "glicko":
+    if args.algorithm in ("glicko", "glicko2"):
         print "Not implemented yet"
         return
 
@@ -371,11 +654,10 @@ def predict(args):
 
         # Query all ratings and store it in a dictionary. This is done for
         # faster access and on-the-fly calculation of new elo values
-        ratings = Rank_Elo.query().all()
+        ratings = Rank_Elo.query().select_related('player_id').all()
         rdict = {}
         for r in ratings:
-            player = Player.query().get(player_id=r.player_id.value)
-            rdict[player.nickname.value] = r
+            rdict[r.player_id.related.nickname.value] = r
 
         for row in reader:
             if line != 0 or (line == 0 and not hasHeader):
@@ -433,6 +715,16 @@ def compare(args):
 
     def compare_glicko(ratings):
         exp = glicko.expectation(ratings[0].rating.value, ratings[1].rating.value, ratings[1].rd.value)
+        print_expectation(exp)
+
+    def compare_glicko2(ratings):
+        exp = glicko2.expectation(
+            glicko2.glickoToGlicko2rating(ratings[0].rating.value),
+            glicko2.glickoToGlicko2rating(ratings[1].rating.value),
+            glicko2.glickoToGlicko2RD(ratings[1].rd.value))
+        print_expectation(exp)
+
+    def print_expectation(exp):
         print "The result is %f.\n" % exp
         if 0.45 <= exp <= 0.55:
             print "They will probably draw."
@@ -467,7 +759,8 @@ def compare(args):
         print "Player with nickname %s not known." % args.player2
         return
 
-    compare_funcs = {'elo': compare_elo, 'glicko': compare_glicko}
+    compare_funcs = {'elo': compare_elo, 'glicko': compare_glicko,
+        'glicko2': compare_glicko2}
     compare_funcs[args.algorithm](ratings)
 
 
@@ -478,7 +771,7 @@ def create_player(args):
     :type args: namespace
     """
     player, created = utils.add_player(args.nickname, args.firstname,
-        args.lastname, True)
+        args.lastname)
     if created is True:
         print "The player is now known in the database:"
         print "ID: %d;\tfirst name: %s;\tlast name: %s;\tnickname: %s" % (
@@ -490,15 +783,18 @@ def create_player(args):
 
 def best_worst(args, best):
     def best_worst_elo():
-        ranks = Rank_Elo.query().all()
-        ranks = sorted(ranks, key=lambda x: x.value.value, reverse=best)
+        # Ties are ordered by id in the same direction as the ratings. Thus,
+        # SQLite reads the top ranks from the index instead of sorting them.
+        ranks = Rank_Elo.query().select_related('player_id').order_by(
+            ('-' if best else '') + 'value',
+            ('-' if best else '') + 'id').limit(args.amount).all()
 
         # the table to print out
         table = [['Rank', 'Rating', 'Nick', 'Firstname', 'Lastname', 'ID']]
         #print "Rank\tRating\tNick\tForename\tSurname\tid"
 
         for i in range(min(args.amount, len(ranks))):
-            player = Player().query().get(player_id=ranks[i].player_id.value)
+            player = ranks[i].player_id.related
             #print "%d\t%d\t%s\t%s,\t%s\t%s" % (i + 1, ranks[i].value.value,
             #    player.nickname.value, player.firstname.value,
             #    player.lastname.value, player.player_id.value)
@@ -507,15 +803,16 @@ def best_worst(args, best):
                 player.lastname.value, player.player_id.value])
         utils.print_table(table)
 
-    def best_worst_glicko():
-        ranks = Rank_Glicko.query().all()
-        ranks = sorted(ranks, key=lambda x: x.rating.value - (x.rd.value), reverse=best)
+    def best_worst_glicko(model=Rank_Glicko):
+        ranks = model.query().select_related('player_id').order_by(
+            ('-' if best else '') + 'rating - rd',
+            ('-' if best else '') + 'id').limit(args.amount).all()
 
         table = [['Rank', 'Rating', 'RD', 'Nick', 'Firstname', 'Lastname', 'ID']]
         #print "Rank\tRating\tRD\tNick\tForename\tSurname\tid"
 
         for i in range(min(args.amount, len(ranks))):
-            player = Player().query().get(player_id=ranks[i].player_id.value)
+            player = ranks[i].player_id.related
             #print "%d\t%d\t%d\t%s\t%s,\t%s\t%s" % (i + 1, ranks[i].rating.value,
             #    ranks[i].rd.value, player.nickname.value, player.firstname.value,
             #    player.lastname.value, player.player_id.value)
@@ -527,7 +824,8 @@ def best_worst(args, best):
     Queries the n best or worst players of a given pair of game and algorithm.
     """
 
-    best_worst_funcs = {'elo': best_worst_elo, 'glicko': best_worst_glicko}
+    best_worst_funcs = {'elo': best_worst_elo, 'glicko': best_worst_glicko,
+        'glicko2': lambda: best_worst_glicko(Rank_Glicko2)}
 
     print "The %s %d players in %s with %s:" % (("Top" if best else "Worst"),
         args.amount, args.game, args.algorithm)
@@ -537,20 +835,14 @@ def best_worst(args, best):
 
 def clear(args):
     def clear_elo():
-        ranks = Rank_Elo.query().all()
-        for rank in ranks:
-            rank.value = 1500
-            rank.save(commit=False)
-        Rank_Elo.commit()
+        Rank_Elo.query().update(value=1500)
 
     def clear_glicko():
-        ranks = Rank_Glicko.query().all()
-        for rank in ranks:
-            rank.rd = 350
-            rank.rating = 350
-            rank.last_match = 0
-            rank.save(commit=False)
-        Rank_Glicko.commit()
+        Rank_Glicko.query().update(rd=350, rating=1500, last_match=1)
+
+    def clear_glicko2():
+        Rank_Glicko2.query().update(rd=350, rating=1500, sigma=0.06,
+            last_match=1)
 
     """
     Clears ranks or matches or both.
@@ -565,14 +857,36 @@ def clear(args):
         (False, True): 'matches', (False, False): ''}
     print "Clearing %s..." % output[args.ranks, args.matches]
 
-    # clear ranks
-    if args.ranks:
-        clear_funcs = {'elo': clear_elo, 'glicko': clear_glicko}
-        clear_funcs[args.algorithm]()
+    with transaction():
+        # clear ranks
+        if args.ranks:
+            clear_funcs = {'elo': clear_elo, 'glicko': clear_glicko,
+                'glicko2': clear_glicko2}
+            clear_funcs[args.algorithm]()
 
-    # clear matches
-    if args.matches:
-        Match1on1.query().truncate()
+        # clear matches
+        if args.matches:
+            Match1on1.query().truncate()
+
+
+def create_indexes(args):
+    """
+    Adds all missing indexes to the database. This is only necessary for
+    databases that were created with an older version of pyChallenge.
+
+    :param args: A list with arguments from the argument parser
+    :type args: namespace
+    """
+    for model in (Config, Match1on1, Player, Rank_Elo, Rank_Glicko,
+            Rank_Glicko2):
+        print "Creating indexes for table %s..." % model._name
+        try:
+            model.create_indexes()
+        except sqlite3.IntegrityError, e:
+            print "\tUnable to create a unique index: %s" % e
+        except sqlite3.OperationalError, e:
+            print "\tUnable to create the indexes: %s" % e
+    print "Done."
 
 
 def history(args):
@@ -581,15 +895,14 @@ def history(args):
         print "Player1 and Player2 are equal. Use 'history <player>'."
         return
 
-    # store all players in a dict (player_id --> player) and get player1/2
-    players = Player.query().all()
-    pdict = {}
-    for player in players:
-        pdict[player.player_id.value] = player
-        if player.nickname.value == args.player1:
-            player1 = player
-        if player.nickname.value == args.player2:
-            player2 = player
+    # get player1/2 with a single query
+    nicknames = filter(None, [args.player1, args.player2])
+    players = Player.get_many('nickname', nicknames)
+    for nickname in nicknames:
+        if nickname not in players:
+            print "Player with nickname %s not known." % nickname
+            return
+    player1 = players[args.player1]
 
     if args.player2 is None:
         print "Searching for the history of %s\n" % args.player1
@@ -602,6 +915,11 @@ def history(args):
             player1=player1.player_id.value).filter(
             player2=player1.player_id.value).join_or().all()
 
+        # store all opponents in a dict (player_id --> player)
+        pdict = Player.get_many('player_id', [player_id
+            for match in matches
+            for player_id in (match.player1.value, match.player2.value)])
+
         won = 0
         lost = 0
         draw = 0
@@ -638,30 +956,22 @@ def history(args):
         print "Won:  %d\nLost: %d\nDraw: %d" % (won, lost, draw)
 
     else:
-        #TODO modify this when IN (...) works
         print "Searching for the history of %s and %s\n" % (args.player1,
             args.player2)
+        player2 = players[args.player2]
+        pdict = {player1.player_id.value: player1,
+            player2.player_id.value: player2}
 
         # the table to print out
         table = [['Winner', 'Date']]
 
-        # get all matches with player 1
-        matches1 = Match1on1.query().filter(
-            player1=player1.player_id.value).filter(
-            player2=player1.player_id.value).join_or().all()
-
-        # get all matches with player 2
-        matches2 = Match1on1.query().filter(
-            player1=player2.player_id.value).filter(
-            player2=player2.player_id.value).join_or().all()
+        # get all matches between player 1 and player 2
+        ids = pdict.keys()
+        matches = Match1on1.query().filter(player1__in=ids,
+            player2__in=ids).order_by('date', 'match_id').all()
 
         statistics = {args.player1: 0, args.player2: 0, 'Draw': 0}
 
-        # Find the intersection of the two list. Other methods do not work
-        # because the 'in' operator does not seem to work with instances
-        matches = [x for x in matches1 if
-            [y for y in matches2 if y.match_id.value == x.match_id.value]]
-
         for match in matches:
             if match.outcome.value == 0:
                 nickname = pdict[match.player2.value].nickname.value
@@ -704,6 +1014,12 @@ def parse(arguments=None):
     parser.add_argument('-v', '--version', action='version',
         version="%s version: %s" % ("%(prog)s", pychallenge.get_version()),
         help='Print out the version of pyChallenge and exit')
+    parser.add_argument('--profile', action='store_true',
+        default=settings.SETTINGS['PROFILE'],
+        help='Print a summary of the executed database statements')
+    parser.add_argument('--slow-query-time', type=float, metavar='SECONDS',
+        default=settings.SETTINGS['SLOW_QUERY_TIME'],
+        help='Log the query plan of statements that take at least SECONDS')
     subparsers = parser.add_subparsers(help='sub-command help')
 
     # import config
@@ -734,6 +1050,9 @@ def parse(arguments=None):
     p_update = subparsers.add_parser('update',
         help='Update the rating values for all players in the given game ' \
              'for the specified algorithm.')
+    p_update.add_argument('-j', '--processes', type=int, metavar='N',
+        help='Rate independent groups of players in N processes. The ' \
+             'default is one process per CPU.')
     p_update.set_defaults(func=update)
 
     # match
@@ -812,6 +1131,11 @@ def parse(arguments=None):
         help='Nickname of player 2')
     p_history.set_defaults(func=history)
 
+    # create indexes
+    p_indexes = subparsers.add_parser('create-indexes',
+        help='Adds all missing indexes to an existing database.')
+    p_indexes.set_defaults(func=create_indexes)
+
     if arguments is None:
         args = parser.parse_args()
     else:
@@ -820,6 +1144,20 @@ def parse(arguments=None):
     if (not utils.prepare_args(args)):
         return
 
+    # databases of older versions lack the tables of new algorithms
+    created = utils.migrate()
+    if created:
+        print "Created the missing tables %s." % ", ".join(created)
+
+    profiler = None
+    if args.profile or args.slow_query_time is not None:
+        profiler = db.start_profiling(args.slow_query_time)
+
     print ""
     args.func(args)
     print ""
+
+    if profiler is not None:
+        db.stop_profiling()
+        if args.profile:
+            print profiler.summary()
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-from pychallenge.models import Player, Rank_Elo, Rank_Glicko, Config
+from pychallenge.db import transaction
+from pychallenge.algorithms import elo, glicko2
+from pychallenge.models import Match1on1, Player, Rank_Elo, Rank_Glicko, \
+    Rank_Glicko2, Config
 import csv
 
 # a list of all supported games
@@ -8,13 +11,17 @@ supported_games = ['chess']
 
 # A mappint game --> algorithm that specifies which algorithm is supported for
 # a game
-supported_algorithms = {'chess': ['elo', 'glicko']}
+supported_algorithms = {'chess': ['elo', 'glicko', 'glicko2']}
 
 
 # outcome --> string
 outcomes = {0.0: "Player 1 lost", 1.0: "Player 1 won", 0.5: "Draw"}
 
 
+# the rank models of all supported algorithms
+rank_models = (Rank_Elo, Rank_Glicko, Rank_Glicko2)
+
+
 def prepare_args(args):
     """
     Prepares the arguments and checks if they  are valid. If not, prints an
@@ -53,8 +60,10 @@ def get_rating(args, p1=None, p2=None):
             return None
         return Rank_Glicko.query().get(player_id=player.player_id.value)
 
-    def rating_glicko2():
-        return None
+    def rating_glicko2(player):
+        if player is None:
+            return None
+        return Rank_Glicko2.query().get(player_id=player.player_id.value)
 
     """
     Queries the rating of a given player or two given players. Returns one
@@ -93,10 +102,16 @@ def get_rating(args, p1=None, p2=None):
     return None
 
 
-def add_player(nickname, firstname="", lastname="", commit=False):
+def add_player(nickname, firstname="", lastname=""):
     """
-    Adds a player and the corresponding ranks to the database. If the player
-    already exsits, this function does nothing.
+    Adds a player and the corresponding ranks to the database in a single
+    transaction. If the player already exsits, this function does nothing.
+
+    The player is inserted with
+    :py:func:`pychallenge.db.models.Model.get_or_create`, which relies on the
+    unique index of the nicknames. Thus, a player is never added twice, even
+    if several processes add the same player at once. Without the index
+    (see create-indexes), the nickname is looked up before the insert.
 
     :param nickname: The nickname of the player to add
     :type nickname: string
@@ -104,25 +119,57 @@ def add_player(nickname, firstname="", lastname="", commit=False):
     :type firstname: string
     :param lastname: The last name of the player to add
     :type lastname: string
-    :param commit: True if the rows should be committed
-    :type commit: bool
     :return: Tupel (the player model, False if player already existed)
     """
-    player = Player.query().get(nickname=nickname)
-    created = False
-    if player == None:
-        created = True
-        player = Player(firstname=firstname, lastname=lastname,
-            nickname=nickname)
-        player.save(commit)
-        rank = Rank_Elo(player_id=player.player_id.value)
-        rank.save(commit)
-        rank = Rank_Glicko(player_id=player.player_id.value)
-        rank.save(commit)
+    with transaction():
+        player, created = Player.get_or_create(nickname=nickname,
+            defaults={'firstname': firstname, 'lastname': lastname})
+        if created:
+            add_ranks([player])
 
     return player, created
 
 
+def add_ranks(players, commit=False):
+    """
+    Adds the default ranks of all supported algorithms for the given players
+    to the database. The ranks of each algorithm are inserted with a single
+    bulk insert.
+
+    :param players: The players (with their player_id set) to add ranks for
+    :type players: list of :py:class:`pychallenge.models.Player`
+    :param commit: True if the rows should be committed
+    :type commit: bool
+    """
+    for rank_class in rank_models:
+        rank_class.bulk_create((rank_class(player_id=p.player_id.value)
+            for p in players), commit=commit)
+
+
+def migrate():
+    """
+    Creates the tables that were added by newer versions of pyChallenge in a
+    database installed by an older version. The ranks of the existing players
+    are added to a new rank table with their default values. A database that
+    was not installed yet (see install.py) is not changed.
+
+    :return: the names of the created tables
+    :rtype: list
+    """
+    if not Player.table_exists():
+        return []
+    created = []
+    for model in (Config, Match1on1) + rank_models:
+        if model.table_exists():
+            continue
+        model.create()
+        if model in rank_models:
+            model.bulk_create([model(player_id=player_id) for player_id in
+                Player.query().values_list('player_id', flat=True)])
+        created.append(model._name)
+    return created
+
+
 #TODO: make this dependend on algorithm (and game)?
 def get_config(args):
     """
@@ -135,9 +182,13 @@ def get_config(args):
     func = Config.query().get(key="elo.chess.function")
     if func is None:
         func = lambda x: (1 / (1 + (10 ** (x / 400.0))))
+        scale = 400.0
     else:
+        scale = elo.logisticScale(func.value.value)
         func = eval(func.value.value)
     dict["elo.chess.function"] = func
+    # the scale of the function if it is logistic, see elo.replay()
+    dict["elo.chess.scale"] = scale
 
     k = Config.query().get(key="elo.chess.k.fide.default")
     if k is None:
@@ -146,6 +197,14 @@ def get_config(args):
         k = float(k.value.value)
     dict["elo.chess.k"] = k
 
+    # GLICKO-2
+    tau = Config.query().get(key="glicko2.chess.tau")
+    if tau is None:
+        tau = glicko2.tau
+    else:
+        tau = float(tau.value.value)
+    dict["glicko2.chess.tau"] = tau
+
     return dict
 
 